@@ -0,0 +1,103 @@
+"""
+Command line client for the /v1/batches API. Submits a JSONL file of chat completion requests
+to a running server, then shows progress until the batch finishes. The server does all the
+scheduling, so this script only polls.
+
+/v1/batches 接口的命令行客户端。把包含对话补全请求的 JSONL 文件提交给运行中的服务器，
+并显示进度直到批处理结束。调度全部由服务器完成，本脚本只负责轮询。
+
+Each input line is either an OpenAI batch line or a bare request body:
+每一行可以是 OpenAI 批处理格式，也可以是裸请求体:
+    {"custom_id": "task-1", "method": "POST", "url": "/v1/chat/completions", "body": {"messages": [...]}}
+    {"messages": [...], "clean_json": false}
+
+File paths are resolved by the server inside its batch_dir (default "batches"): pass them relative
+to that directory, e.g. prompts.jsonl for batches/prompts.jsonl, or as absolute paths inside it.
+文件路径由服务器在其 batch_dir (默认 "batches") 内解析：请传入相对该目录的路径，
+例如 prompts.jsonl 表示 batches/prompts.jsonl，或传入位于该目录内的绝对路径。
+
+Usage / 用法:
+    python batch.py prompts.jsonl --output answers.jsonl
+    python batch.py prompts.jsonl --output answers.jsonl --resume --retry-failed
+    python batch.py --status batch_xxx
+    python batch.py --cancel batch_xxx
+"""
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+def show(batch):
+    counts = batch["request_counts"]
+    progress = batch.get("progress") or {}
+    eta = progress.get("eta_seconds")
+    print(f">>> [{batch['id']}] {batch['status']} | done {counts['completed']} failed {counts['failed']} "
+          f"skipped {counts['skipped']} / {counts['total']} | running {progress.get('running', 0)} "
+          f"| {progress.get('items_per_minute') or '-'} items/min | ETA {f'{eta}s' if eta is not None else '-'}",
+          file=sys.stderr)
+
+def watch(server, batch_id, interval):
+    while True:
+        batch = requests.get(f"{server}/v1/batches/{batch_id}", timeout=30).json()
+        if "error" in batch and "id" not in batch:
+            sys.exit(f"!!! {batch['error']}")
+        show(batch)
+        if batch["status"] in FINAL_STATUSES:
+            return batch
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch client / 批处理客户端")
+    parser.add_argument("input", nargs="?", help="JSONL file of requests, relative to the server's batch_dir / 请求 JSONL 文件，相对服务器的 batch_dir")
+    parser.add_argument("--output", help="Result JSONL file in batch_dir (default: <input>.output.jsonl) / batch_dir 中的结果 JSONL 文件")
+    parser.add_argument("--server", default="http://127.0.0.1:8000")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted batch / 继续被中断的批处理")
+    parser.add_argument("--retry-failed", action="store_true", help="With --resume, run failed items again / 与 --resume 一起使用时重新执行失败条目")
+    parser.add_argument("--max-retries", type=int, help="Retries per item / 每个条目的重试次数")
+    parser.add_argument("--retry-backoff", type=float, help="First retry delay in seconds, doubled per retry / 首次重试等待秒数，每次翻倍")
+    parser.add_argument("--concurrency", type=int, help="Items in flight at once (default: twice the tabs) / 同时进行的条目数 (默认标签页数量的两倍)")
+    parser.add_argument("--interval", type=float, default=2, help="Seconds between progress polls / 进度轮询间隔秒数")
+    parser.add_argument("--status", metavar="BATCH_ID", help="Show progress of a submitted batch / 查看已提交批处理的进度")
+    parser.add_argument("--cancel", metavar="BATCH_ID", help="Cancel a running batch / 取消运行中的批处理")
+    args = parser.parse_args()
+    server = args.server.rstrip("/")
+
+    if args.cancel:
+        show(requests.post(f"{server}/v1/batches/{args.cancel}/cancel", timeout=30).json())
+        return
+    if args.status:
+        batch = watch(server, args.status, args.interval)
+    else:
+        if not args.input:
+            parser.error("an input file is required / 需要输入文件")
+        # The server resolves the paths against its batch_dir, so send them as given / 服务器以其 batch_dir 为基准解析路径，因此原样发送
+        payload = {
+            "input_file": args.input,
+            "output_file": args.output,
+            "resume": args.resume,
+            "retry_failed": args.retry_failed,
+            "max_retries": args.max_retries,
+            "retry_backoff": args.retry_backoff,
+            "concurrency": args.concurrency,
+        }
+        resp = requests.post(f"{server}/v1/batches", json=payload, timeout=30)
+        batch = resp.json()
+        if resp.status_code != 200:
+            sys.exit(f"!!! {batch.get('error')}")
+        print(f">>> Batch submitted / 批处理已提交: {batch['id']} -> {batch['output_file']}", file=sys.stderr)
+        try:
+            batch = watch(server, batch["id"], args.interval)
+        except KeyboardInterrupt:
+            print(f">>> Stopped watching, the batch keeps running. Cancel with: python batch.py --cancel {batch['id']}", file=sys.stderr)
+            print(f">>> 已停止查看，批处理仍在运行。取消方式: python batch.py --cancel {batch['id']}", file=sys.stderr)
+            return
+    print(json.dumps(batch, indent=2, ensure_ascii=False))
+    if batch["status"] != "completed":
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Non-stream collection benchmark: typed internal events versus the previous SSE text round-trip.
+Measures CPU time, peak allocation and garbage collections for one long answer.
+
+非流式收集基准测试：类型化内部事件 对比 之前的 SSE 文本往返。
+测量一条长回复的 CPU 时间、峰值内存分配与垃圾回收次数。
+
+Usage / 用法:
+    python benchmarks/bench_events.py --deltas 20000 --delta-size 40
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import EVENT_DELTA, EVENT_DONE, collect_stream_content
+
+def format_delta_chunk(resp_id, delta):
+    # Previous per-delta SSE formatting / 之前逐个增量的 SSE 格式化
+    chunk_data = {
+        "id": resp_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gemini-web-vision",
+        "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+
+def format_finish_chunk(completion_signal):
+    return f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}], 'completion_signal': completion_signal})}\n\n"
+
+async def sse_lines(deltas):
+    # Previous generator output: every delta serialised to an SSE line
+    # 之前的生成器输出：每个增量都序列化为一行 SSE
+    resp_id = f"chatcmpl-{int(time.time())}"
+    for delta in deltas:
+        yield format_delta_chunk(resp_id, delta)
+    yield format_finish_chunk("network")
+    yield "data: [DONE]\n\n"
+
+async def legacy_collect(lines):
+    # Previous collect_stream_content loop / 之前的 collect_stream_content 循环
+    full_content = ""
+    async for line in lines:
+        if not line.startswith("data: "): continue
+        json_str = line.replace("data: ", "").strip()
+        if json_str == "[DONE]": break
+        try:
+            chunk = json.loads(json_str)
+            choices = chunk.get("choices", [])
+            if choices:
+                full_content += choices[0].get("delta", {}).get("content", "")
+        except: pass
+    return full_content
+
+async def events(deltas):
+    for delta in deltas:
+        yield (EVENT_DELTA, delta)
+    yield (EVENT_DONE, "network")
+
+async def typed_collect(deltas):
+    result = await collect_stream_content(events(deltas), clean_json=False)
+    return result["choices"][0]["message"]["content"]
+
+def measure(name, make_coro, repeat):
+    cpu, peak, collections = [], [], []
+    for _ in range(repeat):
+        gc.collect()
+        gc_before = sum(stat["collections"] for stat in gc.get_stats())
+        tracemalloc.start()
+        start = time.process_time()
+        content = asyncio.run(make_coro())
+        cpu.append(time.process_time() - start)
+        peak.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        collections.append(sum(stat["collections"] for stat in gc.get_stats()) - gc_before)
+    return {
+        "path": name,
+        "chars": len(content),
+        "cpu_s": round(min(cpu), 4),
+        "peak_kb": round(min(peak) / 1024, 1),
+        "gc_collections": min(collections),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Event pipeline benchmark / 事件管道基准测试")
+    parser.add_argument("--deltas", type=int, default=20000)
+    parser.add_argument("--delta-size", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    deltas = [("回复 answer {i} " * args.delta_size)[:args.delta_size] for i in range(args.deltas)]
+    results = [
+        measure("sse_roundtrip", lambda: legacy_collect(sse_lines(deltas)), args.repeat),
+        measure("typed_events", lambda: typed_collect(deltas), args.repeat),
+    ]
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
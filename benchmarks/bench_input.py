@@ -0,0 +1,84 @@
+"""
+Prompt insertion benchmark: time to enter a prompt of each size with every input strategy.
+Runs against a local contenteditable page in a separate headless Chromium, so no Google account is needed.
+
+提示词写入基准测试：用每种输入方式写入不同长度提示词的耗时。
+在独立的无头 Chromium 中针对本地 contenteditable 页面运行，无需 Google 账号。
+
+Usage / 用法:
+    python benchmarks/bench_input.py --sizes 1000 10000 50000 --repeat 3
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DrissionPage import ChromiumPage, ChromiumOptions
+from main import insert_prompt
+
+EDITOR_PAGE = """<!DOCTYPE html>
+<html><body>
+<div contenteditable="true" role="textbox" style="white-space: pre-wrap; min-height: 200px"></div>
+<script>
+// Echo paste events into the editor the way a rich editor would / 像富文本编辑器一样处理粘贴事件
+document.querySelector('div').addEventListener('paste', e => {
+    e.preventDefault();
+    document.execCommand('insertText', false, e.clipboardData.getData('text/plain'));
+});
+</script>
+</body></html>
+"""
+
+def make_prompt(size):
+    line = "【User Input】: Please summarise the following page state and answer in JSON.\n"
+    return (line * (size // len(line) + 1))[:size]
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt insertion benchmark / 提示词写入基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--strategies", nargs="+", default=["insert_text", "paste", "type"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=9444)
+    args = parser.parse_args()
+
+    page_file = os.path.join(tempfile.mkdtemp(), "editor.html")
+    with open(page_file, "w", encoding="utf-8") as f:
+        f.write(EDITOR_PAGE)
+
+    co = ChromiumOptions()
+    co.set_local_port(args.port)
+    co.set_user_data_path(tempfile.mkdtemp())
+    co.headless(True)
+    page = ChromiumPage(co)
+    results = []
+    try:
+        for size in args.sizes:
+            prompt = make_prompt(size)
+            for strategy in args.strategies:
+                timings = []
+                used = None
+                for _ in range(args.repeat):
+                    page.get(f"file://{page_file}")
+                    input_box = page.ele('css:div[contenteditable="true"][role="textbox"]')
+                    start = time.perf_counter()
+                    used = insert_prompt(input_box, prompt, strategy)
+                    timings.append(time.perf_counter() - start)
+                results.append({
+                    "size": size,
+                    "strategy": strategy,
+                    "used": used,
+                    "median_s": round(statistics.median(timings), 4),
+                    "min_s": round(min(timings), 4),
+                })
+                print(f">>> {strategy:<12} {size:>7} chars: {statistics.median(timings):.3f}s (used {used})", file=sys.stderr)
+    finally:
+        page.quit()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
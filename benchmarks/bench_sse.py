@@ -0,0 +1,111 @@
+"""
+Streaming output benchmark: the previous one-frame-per-delta SSE path versus the pre-encoded
+template with and without coalescing. Many simulated streams run concurrently, each receiving
+small deltas at the observer poll rate. Reports frames and bytes per response, CPU time,
+time to first frame and the worst delay a delta spent buffered.
+
+流式输出基准测试：之前每个增量一帧的 SSE 路径 对比 预编码模板 (开启与关闭合并)。
+并发运行多个模拟流，每个流按观察器轮询频率接收小增量。报告每个响应的帧数与字节数、
+CPU 时间、首帧时间以及增量在缓冲中等待的最长时间。
+
+Usage / 用法:
+    python benchmarks/bench_sse.py --streams 50 --deltas 200 --interval-ms 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as server
+from main import EVENT_DELTA, EVENT_DONE, sse_stream
+from bench_events import format_delta_chunk, format_finish_chunk
+
+async def legacy_stream(events):
+    # Previous sse_stream: a new dict and json.dumps for every delta / 之前的 sse_stream：每个增量都新建字典并 json.dumps
+    resp_id = f"chatcmpl-{int(time.time())}"
+    async for kind, value in events:
+        if kind == EVENT_DELTA:
+            yield format_delta_chunk(resp_id, value)
+        elif kind == EVENT_DONE:
+            yield format_finish_chunk(value)
+            yield "data: [DONE]\n\n"
+            return
+
+async def events(deltas, interval, arrivals):
+    for delta in deltas:
+        await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+        arrivals.append(time.perf_counter())
+        yield (EVENT_DELTA, delta)
+    yield (EVENT_DONE, "network")
+
+async def one_stream(render, deltas, interval):
+    arrivals, frames = [], []
+    started = time.perf_counter()
+    async for frame in render(events(deltas, interval, arrivals)):
+        # Starlette encodes str chunks to UTF-8 before sending / Starlette 发送前会把字符串块编码为 UTF-8
+        frames.append((time.perf_counter(), frame if isinstance(frame, bytes) else frame.encode("utf-8")))
+    return started, arrivals, frames
+
+def delays(deltas, arrivals, frames):
+    # Delay of each delta = time until the frame that completed its text / 每个增量的延迟 = 直到包含其全部文本的帧发出
+    sent, result, i = 0, [], 0
+    ends, total = [], 0
+    for delta in deltas:
+        total += len(delta)
+        ends.append(total)
+    for at, frame in frames:
+        for line in frame.split(b"\n\n"):
+            if not line.startswith(b"data: {"): continue
+            choices = json.loads(line[6:]).get("choices") or [{}]
+            sent += len(choices[0].get("delta", {}).get("content", ""))
+        while i < len(ends) and ends[i] <= sent:
+            result.append(at - arrivals[i])
+            i += 1
+    return result
+
+def run(name, render, args, deltas):
+    random.seed(1)
+    cpu = time.process_time()
+    results = asyncio.run(gather(render, args, deltas))
+    cpu = time.process_time() - cpu
+    frames = [len(f) for _, _, f in results]
+    size = [sum(len(frame) for _, frame in f) for _, _, f in results]
+    ttft = [f[0][0] - started for started, _, f in results]
+    worst = max(max(delays(deltas, arrivals, f)) for _, arrivals, f in results)
+    return {
+        "path": name,
+        "frames_per_response": round(sum(frames) / len(frames), 1),
+        "bytes_per_response": round(sum(size) / len(size)),
+        "cpu_ms_per_response": round(cpu / len(results) * 1000, 3),
+        "ttft_ms_avg": round(sum(ttft) / len(ttft) * 1000, 1),
+        "max_delta_delay_ms": round(worst * 1000, 1),
+    }
+
+async def gather(render, args, deltas):
+    return await asyncio.gather(*(one_stream(render, deltas, args.interval_ms / 1000) for _ in range(args.streams)))
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE output benchmark / SSE 输出基准测试")
+    parser.add_argument("--streams", type=int, default=50, help="Concurrent responses / 并发响应数")
+    parser.add_argument("--deltas", type=int, default=200, help="Deltas per response / 每个响应的增量数")
+    parser.add_argument("--delta-size", type=int, default=12)
+    parser.add_argument("--interval-ms", type=float, default=20, help="Mean gap between deltas / 增量之间的平均间隔")
+    args = parser.parse_args()
+
+    deltas = [("回复 token {i} " * args.delta_size)[:args.delta_size] for i in range(args.deltas)]
+    configured = server.SSE_MAX_LATENCY_SECONDS
+    results = [run("legacy_per_delta", legacy_stream, args, deltas)]
+    server.SSE_MAX_LATENCY_SECONDS = 0
+    results.append(run("template_no_coalescing", sse_stream, args, deltas))
+    server.SSE_MAX_LATENCY_SECONDS = configured
+    results.append(run("template_coalesced", sse_stream, args, deltas))
+    print(json.dumps({"settings": {"sse_min_flush_ms": server.SSE_MIN_FLUSH_SECONDS * 1000, "sse_min_flush_chars": server.SSE_MIN_FLUSH_CHARS,
+                                   "sse_max_latency_ms": configured * 1000}, "results": results}, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Load generator for /v1/chat/completions. Drives stream and non-stream requests at several
+concurrency levels and reports throughput, p50/p95/p99 latency and time to first token as JSON.
+Pair it with benchmarks/mock_gemini.py to run without a Google account.
+
+/v1/chat/completions 负载生成器。以多个并发级别发送流式与非流式请求，
+并以 JSON 形式报告吞吐量、p50/p95/p99 延迟与首字时间。
+配合 benchmarks/mock_gemini.py 可在没有 Google 账号的情况下运行。
+
+Usage / 用法:
+    python benchmarks/load_test.py --concurrency 1 2 4 --requests 20 --output run.json
+    python benchmarks/load_test.py --concurrency 1 2 4 --requests 20 --baseline run.json
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_nonce = itertools.count()
+
+def percentile(values, pct):
+    # Nearest-rank percentile / 最近秩百分位数
+    if not values: return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return round(ordered[rank], 4)
+
+def build_payload(args, stream):
+    prompt = args.prompt
+    if not args.same_prompt:
+        # A unique suffix keeps the response cache and request coalescing out of the measurement
+        # 唯一后缀使响应缓存与请求合并不影响测量
+        prompt += f" (request {next(_nonce)} {time.time()})"
+    return {"messages": [{"role": "user", "content": prompt}], "stream": stream, "clean_json": args.clean_json}
+
+def run_one(args, stream):
+    """
+    Send one request. Returns (ok, latency seconds, time to first token seconds or None).
+    发送一个请求。返回 (是否成功, 延迟秒数, 首字时间秒数或 None)。
+    """
+    payload = build_payload(args, stream)
+    start = time.perf_counter()
+    ttft = None
+    try:
+        with requests.post(args.url, json=payload, stream=stream, timeout=args.timeout) as resp:
+            if resp.status_code != 200:
+                return False, time.perf_counter() - start, None
+            if not stream:
+                body = resp.json()
+                ok = bool(body.get("choices"))
+                return ok, time.perf_counter() - start, None
+            ok = False
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "): continue
+                data = line[6:]
+                if data == "[DONE]":
+                    ok = True
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk: break
+                if ttft is None and any(choice.get("delta", {}).get("content") for choice in chunk.get("choices", [])):
+                    ttft = time.perf_counter() - start
+            return ok, time.perf_counter() - start, ttft
+    except requests.RequestException:
+        return False, time.perf_counter() - start, None
+
+def run_level(args, stream, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_one(args, stream), range(args.requests)))
+    wall = time.perf_counter() - started
+    latencies = [latency for ok, latency, _ in results if ok]
+    ttfts = [ttft for ok, _, ttft in results if ok and ttft is not None]
+    return {
+        "mode": "stream" if stream else "non_stream",
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(1 for ok, _, _ in results if not ok),
+        "throughput_rps": round(len(latencies) / wall, 4) if wall else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "ttft_p99": percentile(ttfts, 99),
+    }
+
+def compare(results, baseline):
+    """
+    Relative change of every metric against a baseline run with the same mode and concurrency.
+    每项指标相对于相同模式与并发级别的基线结果的变化比例。
+    """
+    previous = {(row["mode"], row["concurrency"]): row for row in baseline.get("results", [])}
+    changes = []
+    for row in results:
+        old = previous.get((row["mode"], row["concurrency"]))
+        if not old: continue
+        change = {"mode": row["mode"], "concurrency": row["concurrency"]}
+        for key, value in row.items():
+            if key.startswith(("latency", "ttft", "throughput")) and value and old.get(key):
+                change[key] = f"{(value - old[key]) / old[key] * 100:+.1f}%"
+        changes.append(change)
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator / 负载生成器")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/v1/chat/completions")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=20, help="Requests per level / 每个级别的请求数")
+    parser.add_argument("--modes", nargs="+", choices=["stream", "non_stream"], default=["stream", "non_stream"])
+    parser.add_argument("--prompt", default="Please output a JSON object containing 'status' and 'code'")
+    parser.add_argument("--clean-json", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--same-prompt", action="store_true", help="Send identical prompts (exercises cache and coalescing) / 发送相同提示词 (测试缓存与请求合并)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="Write results to this JSON file / 将结果写入该 JSON 文件")
+    parser.add_argument("--baseline", help="Compare against an earlier --output file / 与之前的 --output 文件对比")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        for concurrency in args.concurrency:
+            row = run_level(args, mode == "stream", concurrency)
+            print(f">>> {row['mode']:<10} x{concurrency}: {row['throughput_rps']} req/s, p50 {row['latency_p50']}s, p95 {row['latency_p95']}s, errors {row['errors']}", file=sys.stderr)
+            results.append(row)
+
+    report = {"url": args.url, "requests_per_level": args.requests, "results": results}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["vs_baseline"] = compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
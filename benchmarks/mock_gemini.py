@@ -0,0 +1,220 @@
+"""
+Local stand-in for the Gemini web UI, for offline benchmarks.
+It uses the same selectors as main.py (input box, temp-chat / side-nav buttons, Send / Stop buttons,
+.model-response-text, message-actions, upload previews, error toast). Answers are streamed by a
+StreamGenerate request, so the network completion signal works as on the real site.
+
+用于离线基准测试的本地 Gemini 网页替身。
+使用与 main.py 相同的选择器 (输入框、临时对话 / 侧边栏按钮、发送 / 停止按钮、
+.model-response-text、message-actions、上传预览、错误提示)。回复通过 StreamGenerate 请求流式返回，
+因此网络完成信号与真实网站一致。
+
+Usage / 用法:
+    python benchmarks/mock_gemini.py --port 8765 --chars-per-second 400 --error-rate 0.05
+    then set "target_url": "http://127.0.0.1:8765/app" in config.json
+    然后在 config.json 中设置 "target_url": "http://127.0.0.1:8765/app"
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Mock Gemini</title>
+<style>
+body { font-family: sans-serif; margin: 0; display: flex; }
+nav { width: 200px; padding: 8px; border-right: 1px solid #ccc; }
+nav.collapsed button[data-test-id="temp-chat-button"] { display: none; }
+main { flex: 1; padding: 8px; }
+.temp-chat-on { background: #333; color: #fff; }
+div[role="textbox"] { border: 1px solid #999; min-height: 40px; white-space: pre-wrap; }
+.error-message { position: fixed; bottom: 8px; left: 8px; background: #c00; color: #fff; padding: 8px; }
+</style></head>
+<body>
+<nav class="collapsed">
+  <button data-test-id="side-nav-menu-button" aria-label="Main menu">Menu</button>
+  <button data-test-id="temp-chat-button" class="">Temporary chat</button>
+</nav>
+<main>
+  <div id="conversation"></div>
+  <div id="uploads"></div>
+  <div contenteditable="true" role="textbox" aria-label="Enter a prompt here"></div>
+  <button aria-label="Send message">Send</button>
+</main>
+<script>
+const CONFIG = __CONFIG__;
+const nav = document.querySelector('nav');
+const input = document.querySelector('div[role="textbox"]');
+const send = document.querySelector('button[aria-label="Send message"]');
+const uploads = document.getElementById('uploads');
+const conversation = document.getElementById('conversation');
+let pendingUploads = 0;
+
+document.querySelector('[data-test-id="side-nav-menu-button"]').onclick = () => nav.classList.toggle('collapsed');
+document.querySelector('[data-test-id="temp-chat-button"]').onclick = e => e.currentTarget.classList.toggle('temp-chat-on');
+
+function refreshSend() {
+    send.disabled = pendingUploads > 0;
+    send.setAttribute('aria-disabled', String(pendingUploads > 0));
+}
+
+input.addEventListener('paste', e => {
+    const files = Array.from(e.clipboardData.files || []);
+    if (!files.length) {
+        e.preventDefault();
+        document.execCommand('insertText', false, e.clipboardData.getData('text/plain'));
+        return;
+    }
+    e.preventDefault();
+    files.forEach(file => {
+        const preview = document.createElement('div');
+        preview.className = 'file-preview-container';
+        preview.textContent = file.name;
+        const spinner = document.createElement('div');
+        spinner.setAttribute('role', 'progressbar');
+        preview.appendChild(spinner);
+        uploads.appendChild(preview);
+        pendingUploads++;
+        refreshSend();
+        setTimeout(() => { spinner.remove(); pendingUploads--; refreshSend(); }, CONFIG.upload_delay_ms);
+    });
+});
+
+function showToast() {
+    const toast = document.createElement('div');
+    toast.className = 'error-message';
+    toast.textContent = '出现了点问题 / Something went wrong';
+    document.body.appendChild(toast);
+    setTimeout(() => toast.remove(), 3000);
+}
+
+async function generate(prompt, attachments) {
+    const container = document.createElement('model-response');
+    const text = document.createElement('div');
+    text.className = 'model-response-text';
+    container.appendChild(text);
+    const stop = document.createElement('button');
+    stop.setAttribute('aria-label', 'Stop responding');
+    stop.textContent = 'Stop';
+    const controller = new AbortController();
+    stop.onclick = () => controller.abort();
+    document.querySelector('main').appendChild(stop);
+    await new Promise(r => setTimeout(r, CONFIG.first_token_ms));
+    conversation.appendChild(container);
+    try {
+        const resp = await fetch('/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate', {
+            method: 'POST', body: JSON.stringify({prompt, attachments}), signal: controller.signal
+        });
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        while (true) {
+            const {done, value} = await reader.read();
+            if (done) break;
+            text.textContent += decoder.decode(value, {stream: true});
+        }
+    } catch (e) {
+        // Stopped by the user / 被用户停止
+    }
+    stop.remove();
+    const footer = document.createElement('message-actions');
+    container.appendChild(footer);
+    // Standard chats get their own URL after the first turn / 标准对话在第一轮后获得独立 URL
+    const tempOn = document.querySelector('[data-test-id="temp-chat-button"]').classList.contains('temp-chat-on');
+    if (!tempOn && !location.pathname.startsWith('/app/')) {
+        history.replaceState(null, '', '/app/' + Math.random().toString(16).slice(2, 14));
+    }
+}
+
+send.onclick = () => {
+    if (send.disabled) return;
+    const prompt = input.innerText;
+    const attachments = uploads.children.length;
+    input.textContent = '';
+    uploads.textContent = '';
+    if (Math.random() < CONFIG.error_rate) { showToast(); return; }
+    generate(prompt, attachments);
+};
+</script>
+</body></html>
+"""
+
+def make_answer(prompt, answer_chars, trailing_chars):
+    # A JSON object followed by prose, like a typical browser-use step answer
+    # 一个 JSON 对象加上其后的说明文字，与典型的 browser-use 单步回复类似
+    filler = ("lorem ipsum dolor sit amet " * (answer_chars // 27 + 1))[:max(0, answer_chars - 80)]
+    body = json.dumps({"status": "ok", "echo": prompt[-40:], "filler": filler}, ensure_ascii=False)
+    trailing = ("\n\nThis explanation follows the JSON and is not needed by the client. " * (trailing_chars // 70 + 1))[:trailing_chars]
+    return "```json\n" + body + "\n```" + trailing
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.startswith("/app"):
+            self.send_error(404)
+            return
+        config = {
+            "first_token_ms": self.options.first_token_ms,
+            "upload_delay_ms": self.options.upload_delay_ms,
+            "error_rate": self.options.error_rate,
+        }
+        body = PAGE.replace("__CONFIG__", json.dumps(config)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if "StreamGenerate" not in self.path:
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        answer = make_answer(request.get("prompt", ""), self.options.answer_chars, self.options.trailing_chars)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk_size = self.options.chunk_chars
+        delay = chunk_size / self.options.chars_per_second
+        try:
+            for offset in range(0, len(answer), chunk_size):
+                data = answer[offset:offset + chunk_size].encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client pressed Stop / 客户端点击了停止
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Gemini web UI / Gemini 网页替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chars-per-second", type=float, default=400, help="Streaming speed / 流式速度")
+    parser.add_argument("--chunk-chars", type=int, default=20, help="Characters per network chunk / 每个网络分块的字符数")
+    parser.add_argument("--first-token-ms", type=int, default=800, help="Delay before the answer starts / 回复开始前的延迟")
+    parser.add_argument("--answer-chars", type=int, default=600, help="Size of the JSON answer / JSON 回复大小")
+    parser.add_argument("--trailing-chars", type=int, default=300, help="Prose after the JSON / JSON 之后的说明文字")
+    parser.add_argument("--upload-delay-ms", type=int, default=500, help="Time each upload preview stays loading / 每个上传预览的加载时间")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of turns that show an error toast / 显示错误提示的轮次比例")
+    options = parser.parse_args()
+
+    MockGeminiHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), MockGeminiHandler)
+    server.daemon_threads = True
+    print(f">>> Mock Gemini at http://{options.host}:{options.port}/app / Gemini 替身已启动")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,33 @@
 import time
 import json
+import asyncio
 import os
 import requests
 import base64
 import ast
+import queue
+import heapq
+import itertools
+import math
+import threading
+import hashlib
+import uuid
+import sqlite3
+import re
+import bisect
+from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from requests.adapters import HTTPAdapter
 from DrissionPage import ChromiumPage, ChromiumOptions
-from threading import Lock
 from json_repair import repair_json
 
+# Reference point for the startup report / 启动耗时报告的起点
+PROCESS_STARTED_AT = time.time()
+
 # --- Configuration Section / 配置区域 ---
 
 CONFIG_FILE = "config.json"
@@ -40,7 +57,177 @@ DEFAULT_CONFIG = {
     # 聊天模式配置：
     # True: 强制进入临时对话模式 (temp-chat-on) + 每次对话前强制刷新页面
     # False: 强制进入标准对话模式 (保留历史) + 仅在页面错误时刷新
-    "use_temporary_chat": True
+    "use_temporary_chat": True,
+
+    # Number of browser tabs working in parallel. Each tab serves one request at a time.
+    # 并行工作的浏览器标签页数量。每个标签页同一时间只处理一个请求。
+    "tab_count": 1,
+
+    # Maximum number of requests waiting for a free tab. Extra requests get HTTP 429.
+    # 等待空闲标签页的最大请求数。超出的请求直接返回 HTTP 429。
+    "max_queue_size": 32,
+
+    # Default seconds a request may wait in the queue before HTTP 503 (override with the X-Request-Timeout header)
+    # 请求在队列中等待的默认秒数，超时返回 HTTP 503 (可通过 X-Request-Timeout 请求头覆盖)
+    "queue_timeout": 300,
+
+    # How response text is read while streaming:
+    # "observer": a MutationObserver inside the page buffers new text, Python only drains the buffer
+    # "poll": re-read the whole response element text on every tick
+    # 流式读取回复文本的方式：
+    # "observer": 页面内的 MutationObserver 缓冲新增文本，Python 只负责取走缓冲
+    # "poll": 每次轮询重新读取整个回复元素的文本
+    "stream_mode": "observer",
+
+    # Substring of the network request that streams the answer. When it finishes loading the turn is complete.
+    # 传输回复的网络请求 URL 片段。该请求加载完成即视为本轮回复结束。
+    "completion_network_pattern": "StreamGenerate",
+
+    # Hard upper bound for one answer (seconds)
+    # 单次回复的最长时间上限 (秒)
+    "max_response_seconds": 600,
+
+    # Parallel downloads for image_url entries (also the HTTP connection pool size)
+    # image_url 的并行下载数 (同时也是 HTTP 连接池大小)
+    "image_fetch_workers": 8,
+
+    # Size limit of the in-memory image cache (MB)
+    # 内存图片缓存的大小上限 (MB)
+    "image_cache_max_mb": 64,
+
+    # Folder for the on-disk image cache, empty string disables it
+    # 磁盘图片缓存目录，空字符串表示禁用
+    "image_cache_dir": "",
+
+    # Size limit of the on-disk image cache (MB)
+    # 磁盘图片缓存的大小上限 (MB)
+    "image_cache_disk_max_mb": 512,
+
+    # Maximum seconds to wait for pasted images to finish uploading
+    # 等待粘贴的图片上传完成的最长秒数
+    "image_upload_timeout": 60,
+
+    # Opt-in response cache for byte-identical requests
+    # 针对完全相同请求的回复缓存 (需手动开启)
+    "response_cache_enabled": False,
+
+    # Seconds a cached response stays valid
+    # 缓存回复的有效秒数
+    "response_cache_ttl": 3600,
+
+    # Number of responses kept in memory
+    # 内存中保留的回复数量
+    "response_cache_max_entries": 256,
+
+    # SQLite file that keeps the cache across restarts, empty string means memory only
+    # 跨重启保存缓存的 SQLite 文件，空字符串表示仅使用内存
+    "response_cache_db": "",
+
+    # Temporary chat only: keep a spare tab per worker loaded with a fresh chat, so requests skip navigation
+    # 仅临时对话模式：为每个工作标签页保留一个已加载新对话的备用标签页，请求无需等待页面跳转
+    "prewarm_pages": True,
+
+    # Standard chat only: map each OpenAI-style conversation to its Gemini chat and send only the new messages
+    # 仅标准对话模式：把每个 OpenAI 风格的会话映射到对应的 Gemini 对话，只发送新增消息
+    "conversation_affinity": False,
+
+    # JSON file that keeps the conversation -> Gemini chat mapping across restarts
+    # 跨重启保存 会话 -> Gemini 对话 映射的 JSON 文件
+    "affinity_store_path": "conversation_map.json",
+
+    # How the prompt is entered into the input box:
+    # "insert_text": one CDP Input.insertText call (fastest)
+    # "paste": one text/plain paste event
+    # "type": DrissionPage keystroke-style input (previous behaviour)
+    # 提示词写入输入框的方式：
+    # "insert_text": 一次 CDP Input.insertText 调用 (最快)
+    # "paste": 一次 text/plain 粘贴事件
+    # "type": DrissionPage 逐键输入 (旧方式)
+    "input_strategy": "insert_text",
+
+    # Prompts longer than this many characters are attached as a text file, 0 disables it
+    # 超过该字符数的提示词会以文本文件附件形式发送，0 表示禁用
+    "prompt_attach_threshold": 100000,
+
+    # For clean_json requests, stop Gemini as soon as the first JSON object is complete
+    # (requests with a JSON response_format always do this)
+    # 对 clean_json 请求，第一个 JSON 对象完整后立即停止 Gemini 生成
+    # (指定 JSON response_format 的请求始终如此)
+    "json_early_stop": True,
+
+    # Add a Server-Timing header with per-phase durations to non-stream responses
+    # 在非流式响应中添加包含各阶段耗时的 Server-Timing 响应头
+    "server_timing": True,
+
+    # Extra browser profiles, each its own Chromium process and Google account:
+    # [{"user_data_path": "...", "port": 9334, "weight": 1, "tab_count": 1}, ...]
+    # Empty: a single profile from user_data_path / port / tab_count
+    # 额外的浏览器配置，每个都是独立的 Chromium 进程与 Google 账号：
+    # [{"user_data_path": "...", "port": 9334, "weight": 1, "tab_count": 1}, ...]
+    # 为空时：使用 user_data_path / port / tab_count 组成的单个配置
+    "profiles": [],
+
+    # Cool-down after an error toast, login redirect or rate limit, doubled on each consecutive failure (seconds)
+    # 出现错误提示、登录跳转或限流后的冷却时间，连续失败时逐次翻倍 (秒)
+    "profile_cooldown_base": 30,
+    "profile_cooldown_max": 900,
+
+    # Seconds between background health probes of idle tabs, 0 disables the watchdog.
+    # A profile entry with "standby": true is launched but only takes traffic when another profile fails.
+    # 空闲标签页后台健康探测的间隔秒数，0 表示关闭看门狗。
+    # 带有 "standby": true 的配置会启动，但只在其他配置故障时才接收请求。
+    "watchdog_interval": 1,
+
+    # A probe that gets no answer within this many seconds counts as a dead browser
+    # 探测在该秒数内无响应即视为浏览器已失效
+    "watchdog_probe_timeout": 3,
+
+    # Batch items submitted to the scheduler at once, 0 means twice the number of tabs
+    # 同时提交给调度器的批处理条目数，0 表示标签页数量的两倍
+    "batch_concurrency": 0,
+
+    # Scheduling priority of batch items; below 0 lets interactive requests go first
+    # 批处理条目的调度优先级；小于 0 时交互请求优先执行
+    "batch_priority": -1,
+
+    # Default retries per batch item, and the first back-off delay (seconds, doubled per retry)
+    # 每个批处理条目的默认重试次数，以及首次重试前的等待 (秒，每次重试翻倍)
+    "batch_max_retries": 2,
+    "batch_retry_backoff": 5,
+
+    # Directory that holds batch input and output files; the batch API cannot read or write outside it
+    # 存放批处理输入与输出文件的目录；批处理接口无法读写该目录之外的文件
+    "batch_dir": "batches",
+
+    # Resource groups the browser never downloads: "font", "image", "media", "analytics"
+    # 浏览器不再下载的资源类别："font"、"image"、"media"、"analytics"
+    "blocked_resources": ["font", "media", "analytics"],
+
+    # Extra URL patterns to block, with * wildcards (e.g. "*://example.com/*")
+    # 额外屏蔽的 URL 模式，支持 * 通配符 (例如 "*://example.com/*")
+    "blocked_url_patterns": [],
+
+    # Run Chromium without a window (log in once with a visible window first)
+    # 无窗口运行 Chromium (需先在有窗口模式下完成一次登录)
+    "headless": False,
+
+    # Connect to a Chromium already listening on `port` instead of launching one
+    # 连接已在 `port` 上监听的 Chromium，而不是启动新的浏览器
+    "attach_to_browser": False,
+
+    # Launch the browsers while the API is already accepting requests (see GET /ready)
+    # 在 API 已开始接收请求的同时启动浏览器 (见 GET /ready)
+    "background_start": True,
+
+    # Stream coalescing: after the first chunk, deltas are merged into one SSE frame until at least
+    # sse_min_flush_chars characters and sse_min_flush_ms have accumulated, but no text waits longer
+    # than sse_max_latency_ms. sse_max_latency_ms = 0 sends every delta at once.
+    # 流式合并：首个数据块之后，增量会合并为一个 SSE 帧，直到累计至少 sse_min_flush_chars 个字符
+    # 且距上次发送至少 sse_min_flush_ms 毫秒，但任何文本的等待都不超过 sse_max_latency_ms。
+    # sse_max_latency_ms 为 0 时每个增量立即发送。
+    "sse_min_flush_ms": 50,
+    "sse_min_flush_chars": 64,
+    "sse_max_latency_ms": 200
 }
 
 def load_or_create_config():
@@ -80,108 +267,1548 @@ current_config = load_or_create_config()
 
 USER_DATA_PATH = current_config["user_data_path"]
 TARGET_URL = current_config["target_url"]
+TARGET_HOST = urlparse(TARGET_URL).netloc
 PORT = current_config["port"]
 API_PORT = current_config["api_port"]
 USE_TEMPORARY_CHAT = current_config["use_temporary_chat"]
+TAB_COUNT = max(1, int(current_config["tab_count"]))
+MAX_QUEUE_SIZE = int(current_config["max_queue_size"])
+QUEUE_TIMEOUT = float(current_config["queue_timeout"])
+STREAM_MODE = current_config["stream_mode"]
+COMPLETION_NETWORK_PATTERN = current_config["completion_network_pattern"]
+MAX_RESPONSE_SECONDS = float(current_config["max_response_seconds"])
+IMAGE_FETCH_WORKERS = max(1, int(current_config["image_fetch_workers"]))
+IMAGE_CACHE_MAX_BYTES = int(current_config["image_cache_max_mb"] * 1024 * 1024)
+IMAGE_CACHE_DIR = current_config["image_cache_dir"]
+IMAGE_CACHE_DISK_MAX_BYTES = int(current_config["image_cache_disk_max_mb"] * 1024 * 1024)
+IMAGE_UPLOAD_TIMEOUT = float(current_config["image_upload_timeout"])
+RESPONSE_CACHE_ENABLED = current_config["response_cache_enabled"]
+RESPONSE_CACHE_TTL = float(current_config["response_cache_ttl"])
+RESPONSE_CACHE_MAX_ENTRIES = int(current_config["response_cache_max_entries"])
+RESPONSE_CACHE_DB = current_config["response_cache_db"]
+PREWARM_PAGES = current_config["prewarm_pages"] and USE_TEMPORARY_CHAT
+CONVERSATION_AFFINITY = current_config["conversation_affinity"] and not USE_TEMPORARY_CHAT
+AFFINITY_STORE_PATH = current_config["affinity_store_path"]
+INPUT_STRATEGY = current_config["input_strategy"]
+PROMPT_ATTACH_THRESHOLD = int(current_config["prompt_attach_threshold"])
+JSON_EARLY_STOP = current_config["json_early_stop"]
+SERVER_TIMING = current_config["server_timing"]
+PROFILE_COOLDOWN_BASE = float(current_config["profile_cooldown_base"])
+PROFILE_COOLDOWN_MAX = float(current_config["profile_cooldown_max"])
+WATCHDOG_INTERVAL = float(current_config["watchdog_interval"])
+WATCHDOG_PROBE_TIMEOUT = float(current_config["watchdog_probe_timeout"])
+PROFILES = [
+    {
+        "name": profile.get("name", f"profile-{index}"),
+        "user_data_path": profile["user_data_path"],
+        "port": int(profile["port"]),
+        "weight": max(0.01, float(profile.get("weight", 1))),
+        "tab_count": max(1, int(profile.get("tab_count", TAB_COUNT))),
+        "standby": bool(profile.get("standby", False)),
+    }
+    for index, profile in enumerate(current_config["profiles"])
+] or [{"name": "default", "user_data_path": USER_DATA_PATH, "port": PORT, "weight": 1.0, "tab_count": TAB_COUNT, "standby": False}]
+TOTAL_TABS = sum(profile["tab_count"] for profile in PROFILES)
+BATCH_CONCURRENCY = int(current_config["batch_concurrency"])
+BATCH_PRIORITY = int(current_config["batch_priority"])
+BATCH_MAX_RETRIES = max(0, int(current_config["batch_max_retries"]))
+BATCH_RETRY_BACKOFF = float(current_config["batch_retry_backoff"])
+BATCH_DIR = os.path.realpath(current_config["batch_dir"])
+BLOCKED_RESOURCES = current_config["blocked_resources"]
+BLOCKED_URL_PATTERNS_EXTRA = current_config["blocked_url_patterns"]
+HEADLESS = current_config["headless"]
+ATTACH_TO_BROWSER = current_config["attach_to_browser"]
+BACKGROUND_START = current_config["background_start"]
+SSE_MIN_FLUSH_SECONDS = float(current_config["sse_min_flush_ms"]) / 1000
+SSE_MIN_FLUSH_CHARS = int(current_config["sse_min_flush_chars"])
+SSE_MAX_LATENCY_SECONDS = float(current_config["sse_max_latency_ms"]) / 1000
+if current_config["conversation_affinity"] and USE_TEMPORARY_CHAT:
+    print("!!! conversation_affinity requires use_temporary_chat = false, ignored / conversation_affinity 需要关闭临时对话，已忽略")
 
-browser_lock = Lock()
 page = None
 
+# --- Metrics / 指标 ---
+
+metrics_registry = []
+
+class Metric:
+    """
+    Minimal Prometheus metric. Values are keyed by the tuple of label values.
+    With `read`, values are produced at scrape time from existing state instead.
+    最简 Prometheus 指标。数值按标签值元组存储。
+    指定 `read` 时，数值在抓取时从已有状态中读取。
+    """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), read=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.read = read
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _label_text(self, key, le=None):
+        pairs = list(zip(self.labels, key))
+        if le is not None: pairs.append(("le", le))
+        if not pairs: return ""
+        return "{" + ",".join(name + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if self.read:
+            items = self.read().items()
+        else:
+            with self._lock:
+                items = [(key, list(value) if isinstance(value, list) else value) for key, value in self._values.items()]
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {value}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+SIZE_BUCKETS = (100, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [count per bucket..., count above the last bucket, sum]
+            # [各桶计数..., 超出最后一个桶的计数, 总和]
+            slots = self._values.get(key)
+            if slots is None:
+                slots = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            slots[index] += 1
+            slots[-1] += value
+
+    def _samples(self, key, slots):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, slots):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._label_text(key, str(bound))} {cumulative}")
+        cumulative += slots[len(self.buckets)]
+        lines.append(f"{self.name}_bucket{self._label_text(key, '+Inf')} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {slots[-1]}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+PHASE_SECONDS = Histogram("webai_phase_seconds", "Time spent in each request phase", ("phase",))
+TTFT_SECONDS = Histogram("webai_time_to_first_token_seconds", "Time from request arrival to the first answer text", ("source",))
+REQUEST_SECONDS = Histogram("webai_request_seconds", "Total request latency", ("source", "mode"))
+RESPONSE_CHARS = Histogram("webai_response_chars", "Answer size in characters", ("source",), buckets=SIZE_BUCKETS)
+SSE_FRAMES = Histogram("webai_sse_frames", "SSE frames per streamed response", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+SSE_BYTES = Histogram("webai_sse_bytes", "Bytes sent per streamed response", buckets=SIZE_BUCKETS)
+ERRORS = Counter("webai_errors_total", "Errors by kind", ("kind",))
+NAVIGATION_SECONDS = Histogram("webai_navigation_seconds", "Time to load the Gemini page", ("kind",))
+CANCELLATIONS = Counter("webai_cancellations_total", "Requests abandoned by their clients, by stage", ("stage",))
+
+# Error message prefix -> error kind / 错误信息前缀 -> 错误类型
+ERROR_KINDS = (
+    ("Timeout", "timeout"),
+    ("Gemini Error", "toast"),
+    ("Rate limited", "rate_limit"),
+    ("Login required", "login"),
+    ("Input box not found", "input_not_found"),
+    ("Image upload", "upload"),
+    ("Prompt attachment", "upload"),
+    ("Response does not match schema", "schema"),
+    ("No JSON value", "schema"),
+)
+
+def error_kind(message):
+    for prefix, kind in ERROR_KINDS:
+        if message.startswith(prefix): return kind
+    return "exception"
+
+async def instrument_events(events, started_at, source, mode):
+    """
+    Pass events through, recording time to first token, total latency and answer size for one client.
+    原样转发事件，并记录单个客户端的首字时间、总耗时与回复大小。
+    """
+    chars = 0
+    finished = False
+    async for event in events:
+        kind, value = event
+        if kind == EVENT_DELTA:
+            if not chars and value:
+                TTFT_SECONDS.observe(time.perf_counter() - started_at, source=source)
+            chars += len(value)
+        elif not finished:
+            # Record before forwarding: consumers stop reading at the done event
+            # 先记录再转发：消费者读到结束事件就会停止
+            finished = True
+            REQUEST_SECONDS.observe(time.perf_counter() - started_at, source=source, mode=mode)
+            if kind == EVENT_DONE:
+                RESPONSE_CHARS.observe(chars, source=source)
+        yield event
+
+# --- Tab Pool / 标签页池 ---
+
+INPUT_BOX_SELECTOR = 'css:div[contenteditable="true"][role="textbox"]'
+
+# Marks the current document and the cached input box, so a later probe can tell whether they are still valid.
+# 标记当前文档与缓存的输入框，之后的探测可据此判断它们是否仍然有效。
+JS_STATE_MARK = """
+window.__w2aToken = arguments[0];
+window.__w2aInput = this;
+"""
+
+# Returns [state token, current URL, cached input box still attached].
+# 返回 [状态令牌, 当前 URL, 缓存的输入框是否仍在页面中]。
+JS_STATE_PROBE = """
+return [window.__w2aToken || null, location.href, !!(window.__w2aInput && window.__w2aInput.isConnected)];
+"""
+
+class PageState:
+    """
+    What is known about one tab: URL, chat mode, login status, the input box handle and
+    the number of responses after the last turn. Steady-state requests reuse it instead of
+    probing the DOM. A navigation drops the in-page token and invalidates everything.
+    一个标签页的已知状态：URL、对话模式、登录状态、输入框句柄以及上一轮结束后的回复数量。
+    稳定状态下的请求直接复用，无需探测 DOM。页面跳转会丢失页面内令牌，从而使全部状态失效。
+    """
+    _tokens = itertools.count(1)
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.token = None
+        self.url = None
+        self.chat_mode = None
+        self.logged_in = None
+        self.input_box = None
+        self.response_count = None
+        # Conversation messages the open chat held when this tab last saw it (affinity)
+        # 本标签页上次看到时，打开的对话所含的会话消息数 (会话亲和)
+        self.chat_turns = None
+
+    def navigated(self, url):
+        # We just loaded a new chat ourselves / 刚刚由我们自己加载了新对话
+        self.invalidate()
+        self.url = url
+        self.response_count = 0
+
+    def opened(self, url):
+        # We just opened an existing chat; its response count is unknown / 刚刚打开已有对话，回复数量未知
+        self.invalidate()
+        self.url = url
+
+    def mark(self, input_box):
+        self.token = f"w2a-{next(PageState._tokens)}"
+        self.input_box = input_box
+        input_box.run_js(JS_STATE_MARK, self.token)
+
+    def verify(self, tab):
+        """
+        One round trip that checks the document and cached handles are still the ones we know.
+        Returns True when the cached state can be used as is.
+        通过一次调用确认文档与缓存句柄仍是已知的那些。缓存状态可直接使用时返回 True。
+        """
+        try:
+            token, url, input_alive = tab.run_js(JS_STATE_PROBE)
+        except Exception:
+            token, url, input_alive = None, tab.url, False
+        self.logged_in = "accounts.google.com" not in url
+        if token is None or token != self.token:
+            self.invalidate()
+            self.url = url
+            return False
+        self.url = url
+        if not input_alive:
+            self.input_box = None
+        return self.input_box is not None and self.chat_mode is not None and self.response_count is not None
+
+class PhaseTimer:
+    """
+    Wall time per request phase, printed as a one-line report.
+    每个请求阶段的耗时，以单行报告输出。
+    """
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase, at=None):
+        # `at` closes the phase at an earlier perf_counter() time / `at` 以更早的 perf_counter() 时间结束该阶段
+        now = at or time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    def report(self):
+        parts = [f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items()]
+        parts.append(f"total {time.perf_counter() - self.start:.2f}s")
+        return " | ".join(parts)
+
+    def observe(self):
+        for phase, seconds in self.phases.items():
+            PHASE_SECONDS.observe(seconds, phase=phase)
+
+    def server_timing(self, extra=()):
+        entries = list(extra) + list(self.phases.items())
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in entries)
+
+# Background page warm-up / 后台页面预热
+warm_executor = ThreadPoolExecutor(max_workers=TOTAL_TABS, thread_name_prefix="page-warmup")
+
+class BrowserProfile:
+    """
+    One Chromium process with its own user data directory, i.e. one Google account.
+    After an error toast, login redirect or rate limit the profile leaves the rotation for a
+    cool-down that doubles with each consecutive failure.
+    `state` is "active", "standby" (launched, waiting to replace a failed profile),
+    "suspect" (a probe went unanswered, being confirmed), "recovering" (browser being rebuilt) or "logged_out".
+    一个拥有独立用户数据目录的 Chromium 进程，即一个 Google 账号。
+    出现错误提示、登录跳转或限流后，该配置会退出轮换一段冷却时间，连续失败时冷却时间逐次翻倍。
+    `state` 为 "active"、"standby" (已启动，等待替换故障配置)、"suspect" (探测无应答，正在确认)、
+    "recovering" (浏览器重建中) 或 "logged_out"。
+    """
+    def __init__(self, name, user_data_path, port, weight=1.0, tab_count=1, standby=False):
+        self.name = name
+        self.user_data_path = user_data_path
+        self.port = port
+        self.weight = weight
+        self.tab_count = tab_count
+        self.page = None
+        self.workers = []
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.last_error = None
+        self.stats = {"served": 0, "errors": 0, "cooldowns": 0, "failovers": 0}
+        self.standby = standby
+        self.state = "standby" if standby else "active"
+        # Standby profile activated to cover this one / 为替代本配置而启用的备用配置
+        self.covered_by = None
+        # Headless Chromium announces itself in the user agent, so tabs get the headed one instead
+        # 无头 Chromium 会在 User-Agent 中暴露自身，因此标签页改用有窗口版本的 User-Agent
+        self.user_agent = None
+
+    def available(self, now=None):
+        return self.state == "active" and (now or time.time()) >= self.cooldown_until
+
+    def record_success(self):
+        self.failures = 0
+        self.stats["served"] += 1
+
+    def record_failure(self, kind, message=""):
+        self.failures += 1
+        self.stats["errors"] += 1
+        self.last_error = f"{kind}: {message}"
+        now = time.time()
+        if not any(other is not self and other.available(now) for other in browser_profiles):
+            # Benching the only serving profile would stall every request, so it stays in rotation
+            # 暂停唯一可用的配置会让所有请求停滞，因此保持其轮换
+            print(f"!!! [Profile {self.name}] {kind}, no other profile can take over, staying in rotation / 没有其他配置可接管，保持轮换")
+            return
+        self.stats["cooldowns"] += 1
+        cooldown = min(PROFILE_COOLDOWN_MAX, PROFILE_COOLDOWN_BASE * 2 ** (self.failures - 1))
+        self.cooldown_until = now + cooldown
+        print(f"!!! [Profile {self.name}] {kind}, out of rotation for {cooldown:.0f}s / 账号暂停轮换 {cooldown:.0f} 秒")
+
+    def health(self):
+        return {
+            "name": self.name,
+            "port": self.port,
+            "weight": self.weight,
+            "tabs": len(self.workers),
+            "state": self.state,
+            "available": self.available(),
+            "cooldown_remaining": max(0, round(self.cooldown_until - time.time(), 1)),
+            "consecutive_failures": self.failures,
+            "last_error": self.last_error,
+            **self.stats,
+        }
+
+browser_profiles = [BrowserProfile(**profile) for profile in PROFILES]
+
+# Errors that mean the account itself is in trouble / 表示账号本身出现问题的错误类型
+PROFILE_FAILURE_KINDS = ("toast", "login", "rate_limit")
+
+class TabWorker:
+    """
+    A single browser tab that owns its own input box and response tracking.
+    With page pre-warming, a spare tab is kept loaded with a fresh chat and swapped in per request.
+    单个浏览器标签页，拥有独立的输入框与回复跟踪状态。
+    开启页面预热时，会保留一个已加载新对话的备用标签页，每次请求时直接换入。
+    """
+    def __init__(self, index, tab, spare=None, profile=None):
+        self.index = index
+        self.profile = profile or browser_profiles[0]
+        self.tab = tab
+        self.state = PageState()
+        self.spare = spare
+        self.spare_state = PageState()
+        self._warming = None
+        # Phase timer of the job currently running on this tab / 当前在本标签页上运行的任务的阶段计时器
+        self.timer = PhaseTimer()
+        # Set when every client of the current job has disconnected / 当前任务的所有客户端都断开时被设置
+        self.abort = threading.Event()
+
+    def reattach(self, tab, spare=None):
+        # Point this worker at tabs of a rebuilt browser / 将该工作者指向重建后浏览器的标签页
+        self.tab = tab
+        self.spare = spare
+        self.state = PageState()
+        self.spare_state = PageState()
+        self._warming = None
+        self.start_warming()
+
+    def start_warming(self):
+        if self.spare is not None:
+            self._warming = warm_executor.submit(prepare_fresh_page, self.spare, self.spare_state)
+
+    def take_warm_page(self, timeout=15):
+        """
+        Swap in the spare tab once its warm-up has finished; the old tab becomes the next spare
+        and is warmed in the background while this request runs. Returns False if no warm page is available.
+        备用标签页预热完成后将其换入；旧标签页成为新的备用页，并在本次请求运行期间于后台预热。
+        没有可用的预热页面时返回 False。
+        """
+        if self._warming is None: return False
+        try:
+            ready = self._warming.result(timeout=timeout)
+        except Exception as e:
+            if not self._warming.done():
+                # Still loading, leave it running and navigate the main tab instead
+                # 仍在加载，让其继续运行，主标签页改为自行跳转
+                return False
+            print(f"!!! [Tab {self.index}] Page warm-up failed / 页面预热失败: {e}")
+            ready = False
+        if ready:
+            self.tab, self.spare = self.spare, self.tab
+            self.state, self.spare_state = self.spare_state, self.state
+        self.start_warming()
+        return ready
+
+class TabPool:
+    """
+    Hand out free tabs to requests; a tab is never shared by two requests.
+    Across profiles the least loaded one (busy tabs relative to weight) is chosen, skipping profiles in cool-down.
+    将空闲标签页分配给请求；同一标签页不会被两个请求同时使用。
+    在多个配置之间选择负载最低者 (忙碌标签页数相对于权重)，并跳过冷却中的配置。
+    """
+    def __init__(self):
+        self.workers = []
+        self._free = []
+        self._lock = threading.Lock()
+
+    def add(self, worker):
+        with self._lock:
+            self.workers.append(worker)
+            self._free.append(worker)
+
+    def acquire(self, affinity=None):
+        """
+        Take a free tab without waiting, or None if all usable tabs are busy.
+        `affinity` is a (profile name, tab index) pair owning a conversation: that tab is preferred,
+        then another tab of the profile. While the profile is available but fully busy, None is
+        returned so the request waits for it; a profile that is gone or cooling down is ignored.
+        不等待地取出一个空闲标签页，全部可用标签页忙碌时返回 None。
+        `affinity` 为拥有该会话的 (配置名, 标签页序号)：优先使用该标签页，其次是同一配置的其他标签页。
+        该配置可用但全部忙碌时返回 None，使请求等待它；配置已失效或正在冷却时忽略亲和。
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [worker for worker in self._free if worker.profile.available(now)]
+            if affinity is not None:
+                name, index = affinity
+                owned = [worker for worker in candidates if worker.profile.name == name]
+                if owned:
+                    worker = next((w for w in owned if w.index == index), owned[0])
+                    self._free.remove(worker)
+                    return worker
+                if any(worker.profile.name == name and worker.profile.available(now) for worker in self.workers):
+                    return None
+            if not candidates: return None
+            busy = {}
+            for worker in self.workers:
+                busy[worker.profile] = busy.get(worker.profile, 0) + (worker not in self._free)
+            worker = min(candidates, key=lambda w: (busy[w.profile] + 1) / w.profile.weight)
+            self._free.remove(worker)
+            return worker
+
+    def release(self, worker):
+        with self._lock:
+            self._free.append(worker)
+
+    def idle_workers(self, profile):
+        with self._lock:
+            return [worker for worker in self._free if worker.profile is profile]
+
+    def cooldown_remaining(self):
+        """
+        Seconds until a free tab leaves cool-down, or None if no free tab is cooling down.
+        距离某个空闲标签页结束冷却的秒数；没有冷却中的空闲标签页时返回 None。
+        """
+        now = time.time()
+        with self._lock:
+            waits = [worker.profile.cooldown_until - now for worker in self._free if not worker.profile.available(now)]
+        return max(0.0, min(waits)) if waits else None
+
+    @property
+    def busy_count(self):
+        return len(self.workers) - len(self._free)
+
+    def __len__(self):
+        return len(self.workers)
+
+tab_pool = TabPool()
+
+# --- Internal Events / 内部事件 ---
+# Browser work yields (kind, value) tuples instead of SSE text. The SSE layer and the
+# buffered collector consume them directly, so the non-stream path never touches JSON.
+# 浏览器任务产出 (类型, 值) 元组而非 SSE 文本。SSE 层与缓冲收集器直接消费它们，
+# 非流式路径因此完全不经过 JSON 编解码。
+EVENT_DELTA = "delta"   # value: new answer text / 新增回复文本
+EVENT_ERROR = "error"   # value: error message / 错误信息
+EVENT_DONE = "done"     # value: completion signal / 结束信号
+
+class GenerationError(Exception):
+    pass
+
+# --- Request Scheduler / 请求调度 ---
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Queue full")
+        self.retry_after = retry_after
+
+_JOB_DONE = object()
+
+class Job:
+    """
+    One queued unit of browser work. `run(worker)` is a generator executed on the
+    tab's worker thread; everything it yields is forwarded to the event loop.
+    一个排队的浏览器任务。`run(worker)` 是在标签页工作线程上执行的生成器，
+    其产出的内容会被转发回事件循环。
+    """
+    _counter = itertools.count()
+
+    def __init__(self, run, priority=0, deadline=None, affinity=None):
+        self.run = run
+        self.priority = priority
+        self.deadline = deadline
+        # (profile name, tab index) that owns the conversation, see TabPool.acquire / 拥有该会话的 (配置名, 标签页序号)
+        self.affinity = affinity
+        self.seq = next(Job._counter)
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.started = asyncio.Event()
+        self.cancelled = False
+        self.worker = None
+        # Starts at submission, so the first phase is the queue wait / 从提交时开始计时，第一个阶段即排队等待
+        self.timer = PhaseTimer()
+        # Times this job was moved off a dead browser / 该任务从失效浏览器上转移的次数
+        self.retries = 0
+        # Checked by the generator on the worker thread / 由工作线程中的生成器检查
+        self.abort = threading.Event()
+        # Set when the job is answered without ever running, see fail_pending / 任务未执行即被应答时设置，见 fail_pending
+        self.error = None
+
+    def __lt__(self, other):
+        # Higher priority first, FIFO within the same priority
+        # 优先级高者先执行，同优先级先进先出
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+    def emit(self, item):
+        # Called from the worker thread / 在工作线程中调用
+        self.loop.call_soon_threadsafe(self.events.put_nowait, item)
+
+    async def wait_started(self, deadline=None):
+        # Single-flight joiners wait until their own deadline / 相同请求的加入者等待到各自的截止时间
+        deadline = deadline if deadline is not None else self.deadline
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        try:
+            await asyncio.wait_for(self.started.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self.started.is_set()
+
+    async def stream(self):
+        while True:
+            item = await self.events.get()
+            if item is _JOB_DONE: return
+            yield item
+
+class RequestScheduler:
+    """
+    Asyncio-side admission queue in front of the tab pool.
+    Requests wait in a bounded priority queue; each tab has a dedicated thread
+    that runs the browser work so the event loop never blocks.
+    位于标签页池之前的 asyncio 准入队列。
+    请求在有界优先队列中等待；每个标签页有专属线程执行浏览器操作，事件循环不会被阻塞。
+    """
+    def __init__(self, pool, max_queue_size):
+        self.pool = pool
+        self.max_queue_size = max_queue_size
+        self._pending = []
+        self._inboxes = {}
+        self._loop = None
+        self._wakeup = None
+        # Moving average of how long one job holds a tab (seconds)
+        # 单个任务占用标签页时长的移动平均 (秒)
+        self.avg_service_time = 30.0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for worker in self.pool.workers:
+            inbox = queue.Queue()
+            self._inboxes[worker.index] = inbox
+            threading.Thread(target=self._worker_loop, args=(worker, inbox), daemon=True,
+                             name=f"tab-worker-{worker.index}").start()
+        # Requests accepted while the browsers were starting / 浏览器启动期间已接收的请求
+        self._dispatch()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def retry_after(self):
+        waves = (len(self._pending) + 1) / max(1, len(self.pool))
+        return max(1, math.ceil(waves * self.avg_service_time))
+
+    def submit(self, run, priority=0, timeout=None, affinity=None):
+        if len(self._pending) >= self.max_queue_size:
+            raise QueueFullError(self.retry_after())
+        deadline = None if timeout is None else time.time() + timeout
+        job = Job(run, priority, deadline, affinity)
+        heapq.heappush(self._pending, job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job):
+        """
+        Drop a job that has not started yet. Returns False if it is already running.
+        取消尚未开始的任务。若已开始运行则返回 False。
+        """
+        if job.started.is_set() or job not in self._pending:
+            return False
+        self._pending.remove(job)
+        heapq.heapify(self._pending)
+        job.cancelled = True
+        job.events.put_nowait(_JOB_DONE)
+        return True
+
+    def abort(self, job):
+        """
+        Give up on a job whose clients are all gone: drop it if it is still queued,
+        otherwise ask the running generator to stop Gemini and hand the tab back.
+        放弃所有客户端都已离开的任务：若仍在排队则直接移除，
+        否则通知运行中的生成器停止 Gemini 并归还标签页。
+        """
+        if self.cancel(job):
+            CANCELLATIONS.inc(stage="queued")
+            print(">>> Client disconnected, queued request dropped / 客户端已断开，已移除排队中的请求")
+        elif not job.cancelled:
+            job.abort.set()
+
+    def fail_pending(self, message):
+        """
+        Answer every queued job with an error instead of letting it wait for its queue timeout,
+        e.g. when the browsers could not start. Waiters wake up and find `job.error` set.
+        以错误应答所有排队中的任务，而不是让其等到排队超时，例如浏览器无法启动时。
+        等待者会被唤醒并看到 `job.error`。
+        """
+        jobs, self._pending = self._pending, []
+        for job in jobs:
+            job.error = message
+            job.events.put_nowait((EVENT_ERROR, message))
+            job.events.put_nowait(_JOB_DONE)
+            job.started.set()
+        if jobs:
+            print(f"!!! {len(jobs)} queued requests failed / 排队中的请求已失败: {message}")
+
+    def wake(self):
+        # Thread-safe: re-run dispatch after tabs became usable again / 线程安全：标签页恢复可用后重新分配
+        if self._loop: self._loop.call_soon_threadsafe(self._dispatch)
+
+    def _requeue(self, job):
+        # Retry after a browser failure, ahead of the size limit / 浏览器故障后重试，不受队列长度限制
+        heapq.heappush(self._pending, job)
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._loop is None:
+            # Browsers still starting: requests wait in the queue until start() / 浏览器仍在启动：请求在队列中等待 start()
+            return
+        # Priority order; a job waiting for the profile that owns its chat does not hold up the others
+        # 按优先级顺序；等待其对话所属配置的任务不会阻塞其他任务
+        dispatched = False
+        for job in sorted(self._pending):
+            worker = self.pool.acquire(job.affinity)
+            if worker is None:
+                if job.affinity is None: break
+                continue
+            self._pending.remove(job)
+            dispatched = True
+            job.worker = worker
+            job.timer.mark("queue")
+            job.started.set()
+            self._inboxes[worker.index].put(job)
+        if dispatched:
+            heapq.heapify(self._pending)
+        if self._pending:
+            # Idle tabs whose profile is cooling down: try again when the cool-down ends
+            # 空闲标签页所属配置正在冷却：冷却结束时再次尝试
+            delay = self.pool.cooldown_remaining()
+            if delay is not None:
+                if self._wakeup: self._wakeup.cancel()
+                self._wakeup = self._loop.call_later(delay + 0.05, self._dispatch)
+
+    def _worker_loop(self, worker, inbox):
+        while True:
+            job = inbox.get()
+            started_at = time.time()
+            worker.timer = job.timer
+            worker.abort = job.abort
+            run = job.run(worker)
+            emitted = False
+            retry = False
+            try:
+                for item in run:
+                    if item[0] == EVENT_DELTA:
+                        emitted = True
+                    elif item[0] == EVENT_ERROR:
+                        kind = error_kind(item[1])
+                        # Nothing sent yet and the browser is gone: retry once elsewhere
+                        # 尚未发送任何内容且浏览器已失效：转移到其他地方重试一次
+                        if kind == "exception" and not emitted and watchdog.retry_on_failure(job, worker, item[1]):
+                            retry = True
+                            break
+                        ERRORS.inc(kind=kind)
+                        if kind in PROFILE_FAILURE_KINDS:
+                            worker.profile.record_failure(kind, item[1])
+                    elif item[0] == EVENT_DONE:
+                        worker.profile.record_success()
+                    job.emit(item)
+            except Exception as e:
+                print(f"!!! [Tab {worker.index}] Worker error / 工作线程出错: {e}")
+                if not emitted and watchdog.retry_on_failure(job, worker, str(e)):
+                    retry = True
+                else:
+                    ERRORS.inc(kind="exception")
+                    job.emit((EVENT_ERROR, str(e)))
+            finally:
+                run.close()
+                if job.abort.is_set():
+                    CANCELLATIONS.inc(stage="running")
+                    print(f">>> [Tab {worker.index}] Client disconnected, request cancelled / 客户端已断开，请求已取消")
+                if not retry:
+                    job.timer.observe()
+                    job.emit(_JOB_DONE)
+                elapsed = time.time() - started_at
+                self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * elapsed
+                self.pool.release(worker)
+                if retry:
+                    self._loop.call_soon_threadsafe(self._requeue, job)
+                else:
+                    self._loop.call_soon_threadsafe(self._dispatch)
+
+scheduler = RequestScheduler(tab_pool, MAX_QUEUE_SIZE)
+
 # --- Helper Functions / 辅助函数 ---
 
-def js_paste_image(base64_str, mime_type):
-    """
-    Inject JS to simulate image pasting (automatically generates random filename).
-    注入 JS 模拟粘贴图片 (自动随机文件名)。
-    """
-    base64_clean = base64_str.replace('\n', '').replace('\r', '')
-    js_code = f"""
-    async function doPaste() {{
-        try {{
-            function b64toBlob(b64Data, contentType='', sliceSize=512) {{
-                const byteCharacters = atob(b64Data);
-                const byteArrays = [];
-                for (let offset = 0; offset < byteCharacters.length; offset += sliceSize) {{
-                    const slice = byteCharacters.slice(offset, offset + sliceSize);
-                    const byteNumbers = new Array(slice.length);
-                    for (let i = 0; i < slice.length; i++) {{
-                        byteNumbers[i] = slice.charCodeAt(i);
-                    }}
-                    byteArrays.push(new Uint8Array(byteNumbers));
-                }}
-                return new Blob(byteArrays, {{type: contentType}});
-            }}
-            const blob = b64toBlob('{base64_clean}', '{mime_type}');
-            const ext = '{mime_type}'.split('/')[1] || 'png';
-            const timestamp = new Date().getTime(); 
-            const randomId = Math.floor(Math.random() * 10000);
-            const filename = "img_" + timestamp + "_" + randomId + "." + ext;
-            const file = new File([blob], filename, {{ type: '{mime_type}' }});
-            const dataTransfer = new DataTransfer();
-            dataTransfer.items.add(file);
-            const target = document.querySelector('div[contenteditable="true"]');
-            if (!target) return "not_found";
-            target.focus();
-            const inputEvent = new ClipboardEvent('paste', {{
-                bubbles: true,
-                cancelable: true,
-                clipboardData: dataTransfer
-            }});
-            target.dispatchEvent(inputEvent);
-            return "success";
-        }} catch (e) {{
-            return "error: " + e.message;
-        }}
-    }}
-    return doPaste();
-    """
-    return js_code
+# Base64 characters sent per CDP call when transferring an image into the page
+# 向页面传输图片时每次 CDP 调用发送的 Base64 字符数
+UPLOAD_CHUNK_SIZE = 512 * 1024
+
+# Attachment previews in the input area, and the loading indicators inside them
+# 输入区域中的附件预览，以及预览中的加载指示器
+UPLOAD_PREVIEW_SELECTOR = 'uploader-file-preview, .file-preview-container, [data-test-id="image-preview"]'
+UPLOAD_LOADING_SELECTOR = '[role="progressbar"], mat-progress-spinner, .loading'
+
+# Append one chunk of Base64 for upload `arguments[0]`. The data travels as a call argument, not as JS source.
+# 为上传项 `arguments[0]` 追加一段 Base64。数据作为调用参数传输，而不是拼接进 JS 源码。
+JS_UPLOAD_CHUNK = """
+const store = window.__w2aUpload = window.__w2aUpload || {};
+(store[arguments[0]] = store[arguments[0]] || []).push(arguments[1]);
+"""
+
+# Decode all staged uploads ([[id, mime, filename or null], ...] in `arguments[0]`) and paste them in a single event.
+# 解码所有已暂存的上传项 (`arguments[0]` 为 [[id, mime, 文件名或 null], ...])，并通过一次粘贴事件全部粘贴。
+JS_PASTE_UPLOADS = """
+const uploads = arguments[0];
+const store = window.__w2aUpload || {};
+try {
+    const dataTransfer = new DataTransfer();
+    uploads.forEach(([id, mime, name], i) => {
+        const binary = atob((store[id] || []).join(''));
+        delete store[id];
+        const bytes = new Uint8Array(binary.length);
+        for (let j = 0; j < binary.length; j++) bytes[j] = binary.charCodeAt(j);
+        const ext = mime.split('/')[1] || 'png';
+        const filename = name || ("img_" + Date.now() + "_" + i + "." + ext);
+        dataTransfer.items.add(new File([bytes], filename, {type: mime}));
+    });
+    const target = document.querySelector('div[contenteditable="true"]');
+    if (!target) return "not_found";
+    target.focus();
+    target.dispatchEvent(new ClipboardEvent('paste', {
+        bubbles: true,
+        cancelable: true,
+        clipboardData: dataTransfer
+    }));
+    return "success";
+} catch (e) {
+    return "error: " + e.message;
+}
+"""
+
+# Returns [preview count, previews still loading, send button disabled].
+# 返回 [预览数量, 仍在加载的预览数量, 发送按钮是否禁用]。
+JS_UPLOAD_PROBE = f"""
+const previews = document.querySelectorAll('{UPLOAD_PREVIEW_SELECTOR}');
+let loading = 0;
+previews.forEach(p => {{
+    if (p.querySelector('{UPLOAD_LOADING_SELECTOR}')) loading++;
+    const img = p.tagName === 'IMG' ? p : p.querySelector('img');
+    if (img && !img.complete) loading++;
+}});
+const send = document.querySelector('button[aria-label*="Send"]');
+const disabled = !!send && (send.disabled || send.getAttribute('aria-disabled') === 'true');
+return [previews.length, loading, disabled];
+"""
+
+def count_upload_previews(tab):
+    try:
+        return tab.run_js(JS_UPLOAD_PROBE)[0]
+    except Exception:
+        return 0
+
+def paste_images(tab, images, filenames=None):
+    """
+    Transfer files into the page in fixed-size chunks, then paste them all in one batch.
+    Returns "success" or an error description.
+    以固定大小的分块把文件传入页面，然后一次性批量粘贴。
+    返回 "success" 或错误描述。
+    """
+    uploads = []
+    for index, (b64, mime) in enumerate(images):
+        upload_id = f"u{index}"
+        b64 = b64.replace('\n', '').replace('\r', '')
+        for offset in range(0, len(b64), UPLOAD_CHUNK_SIZE):
+            tab.run_js(JS_UPLOAD_CHUNK, upload_id, b64[offset:offset + UPLOAD_CHUNK_SIZE])
+        uploads.append([upload_id, mime, filenames[index] if filenames else None])
+    return tab.run_js(JS_PASTE_UPLOADS, uploads)
+
+def wait_for_uploads(tab, expected, timeout=IMAGE_UPLOAD_TIMEOUT):
+    """
+    Wait until `expected` attachment previews exist and none of them is still loading.
+    If no preview ever shows up (unknown page layout), fall back to the old fixed 2.5 s per image.
+    等待 `expected` 个附件预览出现且都已加载完成。
+    如果始终没有出现预览 (页面结构未知)，回退为原先每张图片固定等待 2.5 秒。
+    """
+    start = time.time()
+    fallback_wait = 2.5 * expected
+    seen_preview = False
+    while time.time() - start < timeout:
+        try:
+            count, loading, send_disabled = tab.run_js(JS_UPLOAD_PROBE)
+        except Exception:
+            count, loading, send_disabled = 0, 0, False
+        if count: seen_preview = True
+        if count >= expected and not loading and not send_disabled:
+            return True
+        if not seen_preview and time.time() - start >= fallback_wait:
+            return True
+        time.sleep(0.1)
+    return False
+
+# Paste plain text into the focused editor (`this`) in a single event.
+# 通过一次事件把纯文本粘贴到已聚焦的编辑器 (`this`) 中。
+JS_PASTE_TEXT = """
+const dataTransfer = new DataTransfer();
+dataTransfer.setData('text/plain', arguments[0]);
+this.focus();
+this.dispatchEvent(new ClipboardEvent('paste', {bubbles: true, cancelable: true, clipboardData: dataTransfer}));
+"""
+
+# Number of non-whitespace characters in the editor (`this`), used to verify bulk insertion.
+# 编辑器 (`this`) 中非空白字符的数量，用于校验批量写入。
+JS_EDITOR_TEXT_SIZE = """
+return (this.innerText || '').replace(/\\s+/g, '').length;
+"""
+
+# Typed instead of the prompt when the prompt is sent as an attachment
+# 提示词以附件发送时，输入框中改为输入的说明
+PROMPT_ATTACHMENT_NOTE = "The complete conversation is in the attached prompt.txt. Follow its instructions and answer its last user input. / 完整对话见附件 prompt.txt，请按其中的指令回答最后一条用户输入。"
+
+def insert_prompt(input_box, text, strategy=None):
+    """
+    Put the whole prompt into the editor in one operation and verify the editor content.
+    Falls back to keystroke-style input if the content does not match. Returns the strategy that was used.
+    一次性把完整提示词写入编辑器并校验内容。
+    内容不一致时回退为逐键输入。返回实际使用的方式。
+    """
+    strategy = strategy or INPUT_STRATEGY
+    if strategy != "type":
+        try:
+            if strategy == "paste":
+                input_box.run_js(JS_PASTE_TEXT, text)
+            else:
+                input_box.focus()
+                input_box.owner.run_cdp('Input.insertText', text=text)
+            expected = len(re.sub(r'\s+', '', text))
+            if input_box.run_js(JS_EDITOR_TEXT_SIZE) == expected:
+                return strategy
+            print(f"!!! Editor content mismatch after {strategy}, retyping / {strategy} 写入后内容不一致，改为逐键输入")
+        except Exception as e:
+            print(f"!!! Bulk input failed, retyping / 批量写入失败，改为逐键输入: {e}")
+        input_box.input(text, clear=True)
+        return "type"
+    input_box.input(text)
+    return "type"
+
+def attach_prompt_file(tab, text):
+    """
+    Send an oversized prompt as a prompt.txt attachment. Returns "success" or an error description.
+    将超长提示词作为 prompt.txt 附件发送。返回 "success" 或错误描述。
+    """
+    existing_previews = count_upload_previews(tab)
+    b64 = base64.b64encode(text.encode('utf-8')).decode('utf-8')
+    result = paste_images(tab, [(b64, "text/plain")], filenames=["prompt.txt"])
+    if result == "success" and not wait_for_uploads(tab, existing_previews + 1):
+        return "upload timed out"
+    return result
+
+# Installed on the response element (`this`). Buffers text appended after `arguments[0]` characters.
+# 安装在回复元素 (`this`) 上。缓冲第 `arguments[0]` 个字符之后新增的文本。
+JS_STREAM_OBSERVER = """
+const el = this;
+if (window.__w2aObserver) window.__w2aObserver.disconnect();
+const state = {el: el, buf: [], sent: arguments[0] || 0};
+const collect = () => {
+    const text = el.innerText || '';
+    if (text.length > state.sent) {
+        state.buf.push(text.slice(state.sent));
+        state.sent = text.length;
+    }
+};
+window.__w2aObserver = new MutationObserver(collect);
+window.__w2aObserver.observe(el, {childList: true, subtree: true, characterData: true});
+window.__w2aStream = state;
+collect();
+return "ok";
+"""
+
+# Returns [buffered delta, element still attached], or null if no observer is installed.
+# 返回 [缓冲的增量, 元素是否仍在页面中]；未安装观察器时返回 null。
+JS_STREAM_DRAIN = """
+const state = window.__w2aStream;
+if (!state) return null;
+const delta = state.buf.join('');
+state.buf = [];
+return [delta, state.el.isConnected];
+"""
+
+def install_stream_observer(ele, offset):
+    """
+    Start buffering new response text inside the page. Returns False if it cannot be installed.
+    在页面内开始缓冲新增回复文本。无法安装时返回 False。
+    """
+    try:
+        return ele.run_js(JS_STREAM_OBSERVER, offset) == "ok"
+    except Exception as e:
+        print(f"!!! Stream observer install failed, falling back to polling / 观察器安装失败，回退为轮询: {e}")
+        return False
+
+def drain_stream_observer(tab):
+    """
+    Take the text buffered since the last call in one CDP round trip.
+    Returns (delta, alive); alive is False when the observed element was replaced.
+    通过一次 CDP 调用取走自上次调用以来缓冲的文本。
+    返回 (增量, 是否存活)；被观察的元素被替换时 alive 为 False。
+    """
+    result = tab.run_js(JS_STREAM_DRAIN)
+    if not result: return "", False
+    return result[0] or "", bool(result[1])
+
+# Run on the response element. Returns [stop button visible, response footer marked complete].
+# 在回复元素上运行。返回 [停止按钮是否可见, 回复底栏是否已标记完成]。
+JS_COMPLETION_PROBE = """
+const stop = !!document.querySelector('button[aria-label="Stop responding"]');
+const container = this.closest('model-response') || this.parentElement;
+const footer = !!(container && container.querySelector('.response-footer.complete, message-actions'));
+return [stop, footer];
+"""
+
+def start_completion_listener(tab):
+    """
+    Watch for the answer's network stream; returns False if the listener cannot start.
+    监听回复的网络流；监听器无法启动时返回 False。
+    """
+    if not COMPLETION_NETWORK_PATTERN: return False
+    try:
+        # Restarting an active listener only clears old packets / 重启已运行的监听器只会清空旧数据包
+        tab.listen.start(COMPLETION_NETWORK_PATTERN)
+        return True
+    except Exception as e:
+        print(f"!!! Network listener unavailable / 网络监听不可用: {e}")
+        return False
+
+def detect_completion(tab, ele, listening, stop_seen):
+    """
+    Check real page signals for the end of the turn.
+    Returns (signal or None, stop button visible).
+    根据真实页面信号判断本轮是否结束。
+    返回 (信号名或 None, 停止按钮是否可见)。
+    """
+    try:
+        stop_visible, footer_done = ele.run_js(JS_COMPLETION_PROBE)
+    except Exception:
+        stop_visible, footer_done = False, False
+    if stop_visible:
+        return None, True
+    if listening and tab.listen.wait(timeout=0.01, fit_count=False):
+        return "network", False
+    if footer_done:
+        return "response_footer", False
+    if stop_seen:
+        return "stop_button", False
+    return None, False
+
+def stop_generation(tab):
+    """
+    Click "Stop responding" if Gemini is still generating. Returns True if it was clicked.
+    若 Gemini 仍在生成则点击"停止回复"。点击成功返回 True。
+    """
+    try:
+        stop_btn = tab.ele('css:button[aria-label="Stop responding"]', timeout=0.5)
+        if stop_btn:
+            stop_btn.click(by_js=True)
+            return True
+    except Exception as e:
+        print(f"!!! Stop button click failed / 停止按钮点击失败: {e}")
+    return False
+
+# URL patterns per blockable resource group. Network.setBlockedURLs matches URLs, not resource
+# types, so each group is spelled out as file extensions and hosts.
+# 各可屏蔽资源类别对应的 URL 模式。Network.setBlockedURLs 按 URL 而非资源类型匹配，
+# 因此每个类别都以文件扩展名与域名列出。
+RESOURCE_EXTENSIONS = {
+    "font": ("woff2", "woff", "ttf", "otf"),
+    "image": ("png", "jpg", "jpeg", "gif", "webp", "ico", "svg"),
+    "media": ("mp4", "webm", "mp3", "ogg", "wav", "m4a"),
+}
+RESOURCE_HOSTS = {
+    "font": ("*://fonts.gstatic.com/*", "*://fonts.googleapis.com/*"),
+    "analytics": ("*://www.google-analytics.com/*", "*://www.googletagmanager.com/*", "*://play.google.com/log*",
+                  "*/gen_204*", "*://*.doubleclick.net/*"),
+}
+
+def blocked_url_patterns():
+    patterns = []
+    for group in BLOCKED_RESOURCES:
+        if group not in RESOURCE_EXTENSIONS and group not in RESOURCE_HOSTS:
+            print(f"!!! Unknown blocked_resources entry ignored / 忽略未知的 blocked_resources 项: {group}")
+        for ext in RESOURCE_EXTENSIONS.get(group, ()):
+            patterns += [f"*.{ext}", f"*.{ext}?*"]
+        patterns += RESOURCE_HOSTS.get(group, ())
+    return patterns + list(BLOCKED_URL_PATTERNS_EXTRA)
+
+BLOCKED_URL_PATTERNS = blocked_url_patterns()
+
+def apply_page_profile(tab, profile):
+    """
+    Per-tab CDP settings, applied before the tab loads anything: blocked URLs and the headless user agent.
+    每个标签页的 CDP 设置，在其加载任何内容之前应用：屏蔽的 URL 与无头模式的 User-Agent。
+    """
+    try:
+        if BLOCKED_URL_PATTERNS:
+            tab.run_cdp('Network.enable')
+            tab.run_cdp('Network.setBlockedURLs', urls=BLOCKED_URL_PATTERNS)
+        if profile.user_agent:
+            tab.run_cdp('Network.setUserAgentOverride', userAgent=profile.user_agent)
+    except Exception as e:
+        print(f"!!! [Profile {profile.name}] Page profile not applied / 页面配置未生效: {e}")
+
+def navigate(tab, url, kind):
+    """
+    tab.get() that records the page load time (kind: startup, request or prewarm).
+    记录页面加载耗时的 tab.get() (kind：startup、request 或 prewarm)。
+    """
+    started = time.perf_counter()
+    tab.get(url)
+    elapsed = time.perf_counter() - started
+    NAVIGATION_SECONDS.observe(elapsed, kind=kind)
+    return elapsed
+
+def open_tab(profile, url=TARGET_URL):
+    # New tab with the page profile applied before its first load / 新标签页，首次加载前已应用页面配置
+    tab = profile.page.new_tab()
+    apply_page_profile(tab, profile)
+    if url: navigate(tab, url, "startup")
+    return tab
+
+def open_profile_browser(profile):
+    """
+    Launch (or with attach_to_browser, connect to) the profile's Chromium and load Gemini in its first tab.
+    Returns (launch seconds, navigation seconds).
+    启动 (attach_to_browser 时为连接) 该配置的 Chromium，并在第一个标签页中加载 Gemini。
+    返回 (启动秒数, 页面加载秒数)。
+    """
+    if not os.path.exists(profile.user_data_path):
+        os.makedirs(profile.user_data_path)
+    co = ChromiumOptions()
+    co.set_user_data_path(path=profile.user_data_path)
+    co.set_local_port(profile.port)
+    if ATTACH_TO_BROWSER:
+        co.existing_only(True)
+    if HEADLESS:
+        co.headless(True)
+    started = time.perf_counter()
+    profile.page = ChromiumPage(co)
+    launch_seconds = time.perf_counter() - started
+    if HEADLESS:
+        profile.user_agent = profile.page.user_agent.replace("HeadlessChrome", "Chrome")
+    apply_page_profile(profile.page, profile)
+    if ATTACH_TO_BROWSER and TARGET_HOST in (profile.page.url or ""):
+        # The running browser is already on Gemini / 已运行的浏览器已经打开 Gemini
+        return launch_seconds, 0.0
+    return launch_seconds, navigate(profile.page, TARGET_URL, "startup")
+
+def launch_profile(profile):
+    """
+    Start the Chromium process of one profile and add its tabs to the pool.
+    Returns (launch seconds, navigation seconds of the first tab).
+    启动单个配置的 Chromium 进程，并将其标签页加入标签页池。
+    返回 (启动秒数, 第一个标签页的页面加载秒数)。
+    """
+    timings = open_profile_browser(profile)
+    # Extra tabs share the same browser (and login), one per parallel request
+    # 额外标签页共用同一浏览器 (及登录状态)，每个并行请求一个
+    for index in range(profile.tab_count):
+        tab = profile.page if index == 0 else open_tab(profile)
+        worker = TabWorker(len(tab_pool), tab, open_tab(profile, None) if PREWARM_PAGES else None, profile)
+        worker.start_warming()
+        profile.workers.append(worker)
+        tab_pool.add(worker)
+    return timings
+
+# Cold start timings, served by GET /ready / 冷启动耗时，由 GET /ready 提供
+startup_report = {"status": "starting", "error": None, "ready_seconds": None, "profiles": {}}
 
 def init_browser():
     """
-    Initialize the Chromium browser with the specified configuration.
-    使用指定配置初始化 Chromium 浏览器。
+    Initialize one Chromium browser per configured profile.
+    为每个配置的账号初始化一个 Chromium 浏览器。
     """
     global page
-    if not os.path.exists(USER_DATA_PATH):
-        os.makedirs(USER_DATA_PATH)
-    co = ChromiumOptions()
-    co.set_user_data_path(path=USER_DATA_PATH)
-    co.set_local_port(PORT) 
+    mode_str = 'Temp Chat / 临时对话' if USE_TEMPORARY_CHAT else 'Standard Chat / 标准对话'
+    if BLOCKED_URL_PATTERNS:
+        print(f">>> Blocking {len(BLOCKED_URL_PATTERNS)} URL patterns ({', '.join(BLOCKED_RESOURCES) or 'custom'}) / 屏蔽 URL 模式")
+    for profile in browser_profiles:
+        try:
+            launch_seconds, navigation_seconds = launch_profile(profile)
+            startup_report["profiles"][profile.name] = {
+                "launch_seconds": round(launch_seconds, 3),
+                "navigation_seconds": round(navigation_seconds, 3),
+            }
+            print(f">>> Browser {'attached' if ATTACH_TO_BROWSER else 'launched'} [{profile.name}] (Port {profile.port}) | Mode: {mode_str} | Tabs: {len(profile.workers)} | Pre-warm: {PREWARM_PAGES} | Headless: {HEADLESS} | State: {profile.state}")
+            print(f">>> [{profile.name}] Launch {launch_seconds:.2f}s, first page load {navigation_seconds:.2f}s / 启动耗时、首次页面加载耗时")
+        except Exception as e:
+            print(f"!!! Browser launch failed / 浏览器启动失败 [{profile.name}]: {e}")
+            if len(browser_profiles) == 1: raise e
+    if not len(tab_pool):
+        raise RuntimeError("No browser profile could be launched / 没有可启动的浏览器配置")
+    page = next(profile.page for profile in browser_profiles if profile.page)
+
+def rebuild_profile(profile):
+    """
+    Replace a dead browser with a fresh process, reusing the profile's workers.
+    用新的进程替换失效的浏览器，并复用该配置的工作者。
+    """
+    try:
+        profile.page.quit(force=True)
+    except Exception as e:
+        print(f"!!! [Profile {profile.name}] Old browser did not quit cleanly / 旧浏览器未能正常退出: {e}")
+    open_profile_browser(profile)
+    for index, worker in enumerate(profile.workers):
+        tab = profile.page if index == 0 else open_tab(profile)
+        worker.reattach(tab, open_tab(profile, None) if PREWARM_PAGES else None)
+
+# --- Browser Watchdog / 浏览器看门狗 ---
+
+# Returns [current URL, input box present]; answering at all proves the tab is alive over CDP.
+# 返回 [当前 URL, 输入框是否存在]；能够应答本身即证明标签页的 CDP 连接存活。
+JS_WATCHDOG_PROBE = f"""
+return [location.href, !!document.querySelector('{INPUT_BOX_SELECTOR[4:]}')];
+"""
+
+class BrowserWatchdog:
+    """
+    Background health checks of idle tabs: CDP liveness, sign-in redirects and the input box.
+    The first unanswered probe takes the profile out of rotation and fails over to a standby at once;
+    the destructive rebuild only follows after DEAD_PROBES failed probes in a row, otherwise the
+    profile returns to rotation.
+    对空闲标签页进行后台健康检查：CDP 存活、登录跳转与输入框。
+    首次探测无应答即令该配置退出轮换并立即切换到备用配置；只有连续 DEAD_PROBES 次探测失败
+    才会进行破坏性的重建，否则该配置重新加入轮换。
+    """
+    DEAD_PROBES = 3
+    # Seconds between the confirming probes / 确认探测之间的间隔秒数
+    PROBE_PAUSE = 1
+
+    def __init__(self, pool, profiles, interval, probe_timeout):
+        self.pool = pool
+        self.profiles = profiles
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._missing_input = {}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="browser-watchdog").start()
+
+    def probe(self, tab):
+        """
+        Returns "ok", "dead", "logged_out" or "no_input".
+        返回 "ok"、"dead"、"logged_out" 或 "no_input"。
+        """
+        try:
+            # The CDP call itself gives up after the timeout, so a hung browser leaves no thread behind
+            # CDP 调用本身在超时后放弃，浏览器卡死时不会遗留线程
+            url, has_input = tab.run_js(JS_WATCHDOG_PROBE, timeout=self.probe_timeout)
+        except Exception:
+            return "dead"
+        if "accounts.google.com" in (url or ""):
+            return "logged_out"
+        return "ok" if has_input else "no_input"
+
+    def confirm_dead(self, tab, failed=0):
+        """
+        Probe until DEAD_PROBES probes in a row have failed, counting `failed` earlier ones.
+        Returns False as soon as one answers.
+        持续探测直到连续 DEAD_PROBES 次失败 (包含之前已失败的 `failed` 次)。任意一次应答即返回 False。
+        """
+        for attempt in range(failed, self.DEAD_PROBES):
+            if attempt: time.sleep(self.PROBE_PAUSE)
+            if self.probe(tab) != "dead": return False
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for profile in self.profiles:
+                try:
+                    self.check(profile)
+                except Exception as e:
+                    print(f"!!! [Watchdog] Check failed / 检查出错 [{profile.name}]: {e}")
+
+    def check(self, profile):
+        if profile.state in ("suspect", "recovering"): return
+        for worker in self.pool.idle_workers(profile):
+            result = self.probe(worker.tab)
+            if result == "dead":
+                self.suspect(profile, worker.tab, "no answer over CDP")
+                return
+            if result == "logged_out":
+                if profile.state != "logged_out":
+                    print(f"!!! [Watchdog] [{profile.name}] Signed out, waiting for a manual login / 账号已登出，等待手动登录")
+                    self._fail_over(profile, "logged_out")
+                return
+            if result == "no_input":
+                # Twice in a row: drop the cached state so the next request reloads the page
+                # 连续两次：丢弃缓存状态，下一个请求会重新加载页面
+                misses = self._missing_input[worker.index] = self._missing_input.get(worker.index, 0) + 1
+                if misses >= 2:
+                    worker.state.invalidate()
+                    self._missing_input[worker.index] = 0
+            else:
+                self._missing_input[worker.index] = 0
+        if profile.state == "logged_out" and self.pool.idle_workers(profile):
+            # Signed in again / 已重新登录
+            self._restore(profile)
+
+    def retry_on_failure(self, job, worker, message):
+        """
+        Called by a worker after an error with no output sent yet. If the tab's browser is dead,
+        start failover and return True so the job is queued again (once).
+        工作线程在尚未发送任何输出时出错会调用此方法。若该标签页的浏览器已失效，
+        则启动故障切换并返回 True，使任务重新排队 (仅一次)。
+        """
+        if job.retries or self.probe(worker.tab) != "dead":
+            return False
+        job.retries += 1
+        ERRORS.inc(kind="browser_dead")
+        print(f"!!! [Tab {worker.index}] Browser not answering, retrying request elsewhere / 浏览器无应答，请求转移重试: {message}")
+        self.suspect(worker.profile, worker.tab, message)
+        return True
+
+    def suspect(self, profile, tab, reason):
+        """
+        A probe went unanswered: move the traffic away now, and confirm on a separate thread
+        before the rebuild (which force-quits the browser and any busy tabs).
+        探测无应答：立即转移流量，并在单独线程中确认后再重建 (重建会强制关闭浏览器及其忙碌标签页)。
+        """
+        with self._lock:
+            if profile.state in ("suspect", "recovering"): return
+            serving = profile.state == "active"
+            if serving:
+                self._fail_over(profile, "suspect")
+        threading.Thread(target=self._confirm, args=(profile, tab, serving, reason), daemon=True,
+                         name=f"confirm-{profile.name}").start()
+
+    def _confirm(self, profile, tab, serving, reason):
+        if self.confirm_dead(tab, failed=1):
+            self.browser_failed(profile, f"{reason} ({self.DEAD_PROBES} probes unanswered)")
+        elif serving and profile.state == "suspect":
+            print(f">>> [Watchdog] [{profile.name}] Browser answered again / 浏览器重新应答")
+            self._restore(profile)
+
+    def browser_failed(self, profile, reason):
+        with self._lock:
+            if profile.state == "recovering": return
+            profile.last_error = f"browser: {reason}"
+            self._fail_over(profile, "recovering")
+        print(f"!!! [Watchdog] [{profile.name}] Browser failed, rebuilding / 浏览器故障，正在重建: {reason}")
+        threading.Thread(target=self._rebuild, args=(profile,), daemon=True, name=f"rebuild-{profile.name}").start()
+
+    def _fail_over(self, profile, state):
+        was_serving = profile.state == "active"
+        profile.state = state
+        if was_serving:
+            profile.stats["failovers"] += 1
+        if was_serving and profile.covered_by is None:
+            standby = next((other for other in self.profiles if other.state == "standby"), None)
+            if standby:
+                standby.state = "active"
+                profile.covered_by = standby
+                print(f">>> [Watchdog] Standby [{standby.name}] now serving for [{profile.name}] / 备用配置接管流量")
+        scheduler.wake()
+
+    def _restore(self, profile):
+        profile.state = "standby" if profile.standby else "active"
+        standby, profile.covered_by = profile.covered_by, None
+        if standby is not None and standby.state == "active":
+            standby.state = "standby"
+        print(f">>> [Watchdog] [{profile.name}] Back in rotation / 重新加入轮换")
+        scheduler.wake()
+
+    def _rebuild(self, profile):
+        delay = self.interval or 1
+        while True:
+            try:
+                rebuild_profile(profile)
+                self._restore(profile)
+                return
+            except Exception as e:
+                print(f"!!! [Watchdog] [{profile.name}] Rebuild failed, retrying in {delay:.0f}s / 重建失败，{delay:.0f} 秒后重试: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+watchdog = BrowserWatchdog(tab_pool, browser_profiles, WATCHDOG_INTERVAL, WATCHDOG_PROBE_TIMEOUT)
+
+async def start_browsers():
+    """
+    Launch the browsers off the event loop, then start dispatching. Requests that arrive
+    earlier wait in the queue like any other request.
+    在事件循环之外启动浏览器，然后开始分配请求。更早到达的请求与其他请求一样在队列中等待。
+    """
     try:
-        page = ChromiumPage(co)
-        page.get(TARGET_URL)
-        mode_str = 'Temp Chat / 临时对话' if USE_TEMPORARY_CHAT else 'Standard Chat / 标准对话'
-        print(f">>> Browser launched (Port {PORT}) | Mode: {mode_str}")
+        await asyncio.to_thread(init_browser)
     except Exception as e:
-        print(f"!!! Browser launch failed / 浏览器启动失败: {e}")
-        raise e
+        startup_report["status"] = "failed"
+        startup_report["error"] = str(e)
+        print(f"!!! Browser startup failed / 浏览器启动失败: {e}")
+        if not BACKGROUND_START: raise
+        # Requests queued during startup would otherwise wait for their queue timeout
+        # 否则启动期间排队的请求要一直等到排队超时
+        scheduler.fail_pending(f"Browser startup failed: {e}")
+        return
+    scheduler.start()
+    if WATCHDOG_INTERVAL > 0:
+        watchdog.start()
+    startup_report["status"] = "ready"
+    startup_report["ready_seconds"] = round(time.time() - PROCESS_STARTED_AT, 3)
+    print(f">>> Ready to serve {startup_report['ready_seconds']}s after process start / 进程启动后 {startup_report['ready_seconds']} 秒可以提供服务")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_task = None
+    if BACKGROUND_START:
+        # The API answers (and queues requests) while Chromium starts / Chromium 启动期间 API 已可应答 (请求进入队列)
+        startup_task = asyncio.create_task(start_browsers())
+    else:
+        await start_browsers()
+    try:
+        yield
+    finally:
+        # Shut down while still starting: stop waiting for the browsers / 启动尚未完成即关闭：不再等待浏览器
+        if startup_task is not None and not startup_task.done():
+            startup_task.cancel()
+            try:
+                await startup_task
+            except asyncio.CancelledError:
+                pass
+
+app = FastAPI(lifespan=lifespan)
+
+# --- Image Fetching / 图片获取 ---
+
+# Magic bytes -> MIME type / 文件头 -> MIME 类型
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+def sniff_image_mime(data, fallback="image/jpeg"):
+    """
+    Detect the image type from its first bytes.
+    根据文件头识别图片类型。
+    """
+    for signature, mime in IMAGE_SIGNATURES:
+        if data.startswith(signature): return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP": return "image/webp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"avif", b"avis"): return "image/avif"
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"): return "image/heic"
+    return fallback
+
+class ImageCache:
+    """
+    Content-addressed LRU cache of downloaded images (Base64 + MIME), keyed by the URL hash.
+    Memory tier is bounded by total bytes; the optional disk tier keeps raw bytes across restarts.
+    以 URL 哈希为键的图片 LRU 缓存 (Base64 + MIME)。
+    内存层按总字节数限制；可选的磁盘层保存原始字节，重启后仍可用。
+    """
+    def __init__(self, max_bytes, disk_dir="", disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir and not os.path.exists(disk_dir):
+            os.makedirs(disk_dir)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item:
+                self._items.move_to_end(key)
+                return item
+        if not self.disk_dir: return None
+        path = os.path.join(self.disk_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        item = (base64.b64encode(data).decode('utf-8'), sniff_image_mime(data))
+        self._remember(key, item)
+        return item
+
+    def put(self, key, data, mime):
+        item = (base64.b64encode(data).decode('utf-8'), mime)
+        self._remember(key, item)
+        if self.disk_dir:
+            try:
+                with open(os.path.join(self.disk_dir, key), 'wb') as f:
+                    f.write(data)
+                self._trim_disk()
+            except OSError as e:
+                print(f"!!! Image disk cache write failed / 图片磁盘缓存写入失败: {e}")
+        return item
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    init_browser()
-    yield
+    def _remember(self, key, item):
+        size = len(item[0])
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self._items:
+                self._size -= len(self._items.pop(key)[0])
+            self._items[key] = item
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted[0])
 
-app = FastAPI(lifespan=lifespan)
+    def _trim_disk(self):
+        # Evict least recently used files (by mtime) / 按修改时间淘汰最久未使用的文件
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes: break
+            os.remove(path)
+            total -= size
+
+image_cache = ImageCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_DIR, IMAGE_CACHE_DISK_MAX_BYTES)
+
+# Shared keep-alive session; pool size matches the download concurrency
+# 共享的长连接会话；连接池大小与下载并发数一致
+http_session = requests.Session()
+http_session.headers["User-Agent"] = "Mozilla/5.0"
+http_session.mount("http://", HTTPAdapter(pool_connections=IMAGE_FETCH_WORKERS, pool_maxsize=IMAGE_FETCH_WORKERS))
+http_session.mount("https://", HTTPAdapter(pool_connections=IMAGE_FETCH_WORKERS, pool_maxsize=IMAGE_FETCH_WORKERS))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
 
 def download_image_to_base64(url_or_base64):
     """
     Convert image URL or Data URI to Base64 string.
+    Remote images go through the image cache; Data URIs are decoded in place.
     将图片 URL 或 Data URI 转换为 Base64 字符串。
+    远程图片经过图片缓存；Data URI 直接就地解析。
     """
     try:
         if url_or_base64.startswith("data:image"):
             header, encoded = url_or_base64.split(",", 1)
-            mime_type = header.split(":")[1].split(";")[0]
+            declared = header.split(":")[1].split(";")[0]
+            # Only the first bytes are needed to verify the declared type; line-wrapped base64 is allowed
+            # 只需解码开头几个字节来核对声明的类型；允许带换行的 base64
+            head = "".join(encoded[:64].split())[:32]
+            try:
+                mime_type = sniff_image_mime(base64.b64decode(head[:len(head) // 4 * 4]), declared)
+            except ValueError:
+                mime_type = declared
             return encoded, mime_type
         elif url_or_base64.startswith("http"):
-            headers = {"User-Agent": "Mozilla/5.0"}
-            resp = requests.get(url_or_base64, headers=headers, timeout=15)
+            key = hashlib.sha256(url_or_base64.encode('utf-8')).hexdigest()
+            cached = image_cache.get(key)
+            if cached: return cached
+            resp = http_session.get(url_or_base64, timeout=15)
             if resp.status_code == 200:
-                encoded = base64.b64encode(resp.content).decode('utf-8')
-                mime_type = "image/jpeg" 
-                if url_or_base64.endswith(".png"): mime_type = "image/png"
-                return encoded, mime_type
+                content_type = resp.headers.get("Content-Type", "").split(";")[0].strip()
+                fallback = content_type if content_type.startswith("image/") else "image/jpeg"
+                return image_cache.put(key, resp.content, sniff_image_mime(resp.content, fallback))
             else:
                 return None, None
         else:
@@ -190,13 +1817,21 @@ def download_image_to_base64(url_or_base64):
         print(f"!!! Image to Base64 failed / 图片转Base64失败: {e}")
         return None, None
 
+def resolve_images(urls):
+    """
+    Download all images concurrently, keeping their original order and skipping failures.
+    并发下载所有图片，保持原有顺序并跳过失败项。
+    """
+    unique = list(dict.fromkeys(urls))
+    results = dict(zip(unique, image_executor.map(download_image_to_base64, unique)))
+    return [results[url] for url in urls if results[url][0]]
+
 def process_full_conversation(messages):
     """
     [Mode A: Full Context] Concatenate full history.
     【模式A：全量】拼接完整历史。
     """
     full_text = ""
-    all_images = []
     
     for msg in messages:
         role = msg.get("role", "unknown")
@@ -216,15 +1851,15 @@ def process_full_conversation(messages):
         elif role == "assistant":
             full_text += f"【Model Output History】:\n{text_part}\n\n"
 
+    urls = []
     for msg in messages:
         content = msg.get("content", "")
         if isinstance(content, list):
             for item in content:
                 if item.get("type") == "image_url":
                     url = item.get("image_url", {}).get("url", "")
-                    if url:
-                        b64, mime = download_image_to_base64(url)
-                        if b64: all_images.append((b64, mime))
+                    if url: urls.append(url)
+    all_images = resolve_images(urls)
     return full_text.strip(), all_images
 
 def process_last_message_only(messages):
@@ -236,7 +1871,6 @@ def process_last_message_only(messages):
     last_msg = messages[-1]
     content = last_msg.get("content", "")
     text_part = ""
-    current_images = []
     
     if isinstance(content, list):
         for item in content:
@@ -245,42 +1879,40 @@ def process_last_message_only(messages):
     elif isinstance(content, str):
         text_part = content
         
+    urls = []
     if isinstance(content, list):
         for item in content:
             if item.get("type") == "image_url":
                 url = item.get("image_url", {}).get("url", "")
-                if url:
-                    b64, mime = download_image_to_base64(url)
-                    if b64: current_images.append((b64, mime))
+                if url: urls.append(url)
+    current_images = resolve_images(urls)
     return text_part.strip(), current_images
 
 # --- Key Modification: collect_stream_content receives clean_json parameter ---
 # --- 关键修改：collect_stream_content 接收 clean_json 参数 ---
-async def collect_stream_content(generator, clean_json=True):
+async def collect_stream_content(events, clean_json=True):
     """
-    Consume the generator.
+    Consume the internal event stream. Raises GenerationError on an error event.
     clean_json=True: Repair JSON using json_repair, force unpack list (Browser-Use mode)
     clean_json=False: Return Gemini's response as is (Chat mode)
     
-    消费生成器。
+    消费内部事件流。遇到错误事件时抛出 GenerationError。
     clean_json=True: 使用 json_repair 修复，强制解包列表 (Browser-Use 模式)
     clean_json=False: 原样返回 Gemini 的回复 (Chat 模式)
     """
-    full_content = ""
+    parts = []
     last_id = f"chatcmpl-{int(time.time())}"
+    completion_signal = None
     
-    for line in generator:
-        if not line.startswith("data: "): continue
-        json_str = line.replace("data: ", "").strip()
-        if json_str == "[DONE]": break
-        try:
-            chunk = json.loads(json_str)
-            if not last_id and chunk.get("id"): last_id = chunk.get("id")
-            choices = chunk.get("choices", [])
-            if choices:
-                delta = choices[0].get("delta", {})
-                full_content += delta.get("content", "")
-        except: pass
+    async for kind, value in events:
+        if kind == EVENT_DELTA:
+            parts.append(value)
+        elif kind == EVENT_DONE:
+            completion_signal = value
+            break
+        elif kind == EVENT_ERROR:
+            raise GenerationError(value)
+    full_content = "".join(parts)
 
     print(f">>> [Non-Stream] Raw Text Length / 原始文本长度: {len(full_content)}")
 
@@ -335,28 +1967,712 @@ async def collect_stream_content(generator, clean_json=True):
         "object": "chat.completion",
         "created": int(time.time()),
         "model": "gemini-web-agent",
-        "choices": [{"index": 0, "message": {"role": "assistant", "content": final_content}, "finish_reason": "stop"}]
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": final_content}, "finish_reason": "stop"}],
+        # Which page signal ended the turn (diagnostics) / 结束本轮的页面信号 (诊断用)
+        "completion_signal": completion_signal
+    }
+
+# --- Structured Output / 结构化输出 ---
+
+class JsonExtractor:
+    """
+    Tracks the first balanced JSON object (or array) in a growing answer.
+    Deltas are scanned once. A balanced candidate that does not parse is repaired with json_repair as a whole,
+    like the clean_json path; only a candidate that cannot be repaired is skipped, and scanning resumes after it.
+    跟踪不断增长的回复中第一个括号平衡的 JSON 对象 (或数组)。
+    增量只扫描一次。平衡但无法解析的候选会像 clean_json 流程一样整体交给 json_repair 修复；
+    只有无法修复的候选才会被跳过，并从其之后继续扫描。
+    """
+    def __init__(self, opener="{"):
+        self.opener = opener
+        self.closer = "}" if opener == "{" else "]"
+        self.raw = ""
+        self.text = None
+        self.value = None
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def complete(self):
+        return self.text is not None
+
+    def feed(self, delta):
+        """
+        Add a delta; returns True once a complete JSON value has been found.
+        追加增量；找到完整的 JSON 值后返回 True。
+        """
+        self.raw += delta
+        while self.text is None and self._pos < len(self.raw):
+            if self._start < 0:
+                start = self.raw.find(self.opener, self._pos)
+                if start < 0:
+                    self._pos = len(self.raw)
+                    break
+                self._start, self._pos, self._depth = start, start, 0
+            char = self.raw[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape: self._escape = False
+                elif char == "\\": self._escape = True
+                elif char == '"': self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.raw[self._start:self._pos]
+                    try:
+                        self.value = json.loads(candidate)
+                        self.text = candidate
+                    except ValueError:
+                        # Never rescan inside the outer value: that would return a nested object
+                        # 不在外层值内部重新扫描：那样会返回内层的嵌套对象
+                        self._repair(candidate)
+                        self._start = -1
+        return self.complete
+
+    def _repair(self, candidate):
+        try:
+            value = repair_json(candidate, return_objects=True)
+        except Exception:
+            return
+        if isinstance(value, dict if self.opener == "{" else list) and value:
+            self.value = value
+            self.text = json.dumps(value, ensure_ascii=False)
+
+class StructuredOutput:
+    """
+    What a request expects back: a JSON value, optionally checked against a JSON schema.
+    请求期望的返回：一个 JSON 值，可选地按 JSON schema 校验。
+    """
+    def __init__(self, schema=None, strict=False, source="response_format"):
+        self.schema = schema
+        self.strict = strict
+        self.source = source
+        self.opener = "[" if isinstance(schema, dict) and schema.get("type") == "array" else "{"
+
+    def instruction(self):
+        # Appended to the prompt so the web model knows the expected shape
+        # 附加到提示词末尾，让网页模型知道期望的格式
+        if self.source != "response_format": return ""
+        if self.schema:
+            return "\n\n[Output Format]: Reply with one JSON value that matches this JSON schema, and nothing else:\n" + json.dumps(self.schema, ensure_ascii=False)
+        return "\n\n[Output Format]: Reply with one JSON object and nothing else."
+
+    def validate(self, value):
+        return validate_json_schema(value, self.schema) if self.schema else None
+
+def parse_response_format(data, clean_json, is_stream=False):
+    """
+    Build the StructuredOutput for a request, or None for free text. The implicit clean_json early stop
+    only applies to non-stream requests, because it holds back the deltas until the JSON closes.
+    为请求构造 StructuredOutput，自由文本请求返回 None。隐式的 clean_json 提前结束只用于非流式请求，
+    因为它会把增量一直缓冲到 JSON 闭合。
+    """
+    response_format = data.get("response_format") or {}
+    kind = response_format.get("type") if isinstance(response_format, dict) else None
+    if kind == "json_schema":
+        spec = response_format.get("json_schema") or {}
+        return StructuredOutput(spec.get("schema"), bool(spec.get("strict")))
+    if kind == "json_object":
+        return StructuredOutput()
+    if clean_json and JSON_EARLY_STOP and not is_stream:
+        return StructuredOutput(source="clean_json")
+    return None
+
+JSON_SCHEMA_TYPES = {
+    "object": dict, "array": list, "string": str, "boolean": bool, "null": type(None),
+    "number": (int, float), "integer": int,
+}
+
+def validate_json_schema(value, schema, root=None, path="$"):
+    """
+    Minimal JSON schema check (type, enum, const, properties, required, additionalProperties,
+    items, min/maxItems, anyOf/oneOf/allOf, local $ref). Returns the first error or None.
+    最简 JSON schema 校验 (type、enum、const、properties、required、additionalProperties、
+    items、min/maxItems、anyOf/oneOf/allOf、本地 $ref)。返回第一个错误或 None。
+    """
+    root = root if root is not None else schema
+    if not isinstance(schema, dict): return None
+    if "$ref" in schema:
+        target = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            if part: target = target.get(part, {}) if isinstance(target, dict) else {}
+        return validate_json_schema(value, target, root, path)
+    for key in ("anyOf", "oneOf"):
+        if key in schema and all(validate_json_schema(value, option, root, path) for option in schema[key]):
+            return f"{path}: does not match any allowed schema"
+    for option in schema.get("allOf", []):
+        error = validate_json_schema(value, option, root, path)
+        if error: return error
+    if "const" in schema and value != schema["const"]:
+        return f"{path}: expected {schema['const']!r}"
+    if "enum" in schema and value not in schema["enum"]:
+        return f"{path}: {value!r} not in enum"
+    types = schema.get("type")
+    if types:
+        types = types if isinstance(types, list) else [types]
+        def matches(name):
+            if name in ("integer", "number") and isinstance(value, bool): return False
+            return isinstance(value, JSON_SCHEMA_TYPES.get(name, object))
+        if not any(matches(name) for name in types):
+            return f"{path}: expected {'/'.join(types)}, got {type(value).__name__}"
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in value: return f"{path}: missing required property '{name}'"
+        extra = schema.get("additionalProperties", True)
+        for name, item in value.items():
+            if name in properties:
+                error = validate_json_schema(item, properties[name], root, f"{path}.{name}")
+            elif extra is False:
+                error = f"{path}: unexpected property '{name}'"
+            else:
+                error = validate_json_schema(item, extra, root, f"{path}.{name}") if isinstance(extra, dict) else None
+            if error: return error
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0): return f"{path}: too few items"
+        if "maxItems" in schema and len(value) > schema["maxItems"]: return f"{path}: too many items"
+        if isinstance(schema.get("items"), dict):
+            for index, item in enumerate(value):
+                error = validate_json_schema(item, schema["items"], root, f"{path}[{index}]")
+                if error: return error
+    return None
+
+# --- SSE Output / SSE 输出 ---
+
+def estimate_tokens(chars):
+    # Gemini web reports no token counts; about 4 characters per token / Gemini 网页版不提供 token 数；约 4 个字符一个 token
+    return math.ceil(chars / 4)
+
+class SSEEncoder:
+    """
+    Chunk serializer for one streamed response. The JSON around the delta text is encoded once,
+    so each frame only escapes the new text.
+    单个流式响应的数据块序列化器。增量文本之外的 JSON 只编码一次，每一帧只需转义新增文本。
+    """
+    def __init__(self, model="gemini-web-vision"):
+        self.head = {
+            "id": f"chatcmpl-{int(time.time())}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+        }
+        prefix = json.dumps(self.head, ensure_ascii=False)[:-1]
+        self._delta_prefix = f'data: {prefix}, "choices": [{{"index": 0, "delta": {{"content": '.encode('utf-8')
+        self._delta_suffix = b'}, "finish_reason": null}]}\n\n'
+
+    def delta(self, text):
+        return self._delta_prefix + encode_json_string(text).encode('utf-8') + self._delta_suffix
+
+    def frame(self, **fields):
+        return f"data: {json.dumps({**self.head, **fields}, ensure_ascii=False)}\n\n".encode('utf-8')
+
+# Same output as json.dumps(text, ensure_ascii=False) without building an encoder per call
+# 与 json.dumps(text, ensure_ascii=False) 输出相同，但无需每次调用都构造编码器
+encode_json_string = json.encoder.encode_basestring
+
+async def sse_stream(events, include_usage=False, prompt_chars=0):
+    """
+    Render internal events as OpenAI-style SSE frames. The first delta goes out at once; later
+    deltas are coalesced (see sse_min_flush_* / sse_max_latency_ms). The stream ends with a
+    finish_reason chunk, a usage chunk when the client asked for it
+    (stream_options.include_usage), then [DONE].
+    将内部事件渲染为 OpenAI 风格的 SSE 帧。首个增量立即发送；之后的增量会被合并
+    (见 sse_min_flush_* / sse_max_latency_ms)。流以 finish_reason 数据块结束，客户端要求时
+    (stream_options.include_usage) 再附带 usage 数据块，最后是 [DONE]。
+    """
+    encoder = SSEEncoder()
+    loop = asyncio.get_running_loop()
+    buffer = []
+    buffered_chars = 0
+    buffered_since = None
+    last_flush = None
+    sent_chars = 0
+    frames = 0
+    sent_bytes = 0
+    finished = None
+    wake = None
+
+    def deadline():
+        # When the buffer must go out even if nothing else arrives / 即使没有新数据也必须发送缓冲的时间点
+        if last_flush is None:
+            # Nothing sent yet: the first frame is due now / 尚未发送任何内容：首帧立即到期
+            return loop.time()
+        at = buffered_since + SSE_MAX_LATENCY_SECONDS
+        if buffered_chars >= SSE_MIN_FLUSH_CHARS:
+            at = min(at, last_flush + SSE_MIN_FLUSH_SECONDS)
+        return at
+
+    def notify():
+        if wake is not None and not wake.done():
+            wake.set_result(None)
+
+    async def pump():
+        # Reads events into the buffer; the writer below only wakes once per frame
+        # 把事件读入缓冲；下面的写出循环每帧只唤醒一次
+        nonlocal buffered_chars, buffered_since, finished
+        try:
+            async for kind, value in events:
+                if kind == EVENT_DELTA:
+                    if not value: continue
+                    buffer.append(value)
+                    buffered_chars += len(value)
+                    if buffered_since is None:
+                        # Empty -> non-empty: the writer arms its latency timer / 空变为非空：写出循环设置延迟定时器
+                        buffered_since = loop.time()
+                        notify()
+                    elif buffered_chars >= SSE_MIN_FLUSH_CHARS and loop.time() >= deadline():
+                        notify()
+                elif kind in (EVENT_ERROR, EVENT_DONE):
+                    finished = (kind, value)
+                    break
+        except Exception as e:
+            finished = (None, e)
+        finally:
+            if finished is None:
+                finished = (None, None)
+            notify()
+
+    def flush():
+        nonlocal buffered_chars, buffered_since, last_flush, sent_chars, frames, sent_bytes
+        frame = encoder.delta("".join(buffer))
+        sent_chars += buffered_chars
+        buffer.clear()
+        buffered_chars = 0
+        buffered_since = None
+        last_flush = loop.time()
+        frames += 1
+        sent_bytes += len(frame)
+        return frame
+
+    reader = asyncio.ensure_future(pump())
+    try:
+        while finished is None:
+            wake = loop.create_future()
+            timer = None
+            if buffer:
+                if last_flush is None or SSE_MAX_LATENCY_SECONDS <= 0 or loop.time() >= deadline():
+                    yield flush()
+                    continue
+                timer = loop.call_at(deadline(), notify)
+            await wake
+            if timer is not None:
+                timer.cancel()
+            if buffer and (last_flush is None or SSE_MAX_LATENCY_SECONDS <= 0 or loop.time() >= deadline()):
+                yield flush()
+
+        kind, value = finished
+        if kind is None and value is not None:
+            raise value
+        tail = [flush()] if buffer else []
+        closing = []
+        if kind == EVENT_ERROR:
+            closing.append(f"data: {json.dumps({'error': value}, ensure_ascii=False)}\n\n".encode('utf-8'))
+        elif kind == EVENT_DONE:
+            # "length" when the answer was cut off by max_response_seconds / 因 max_response_seconds 截断时为 "length"
+            finish_reason = "length" if value == "timeout" else "stop"
+            closing.append(encoder.frame(choices=[{"index": 0, "delta": {}, "finish_reason": finish_reason}], completion_signal=value))
+            if include_usage:
+                prompt_tokens, completion_tokens = estimate_tokens(prompt_chars), estimate_tokens(sent_chars)
+                closing.append(encoder.frame(choices=[], usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }))
+            closing.append(b"data: [DONE]\n\n")
+        frames += len(closing)
+        sent_bytes += sum(len(frame) for frame in closing)
+        if tail or closing:
+            # Remaining text and terminal frames go out as one write / 剩余文本与结束帧一次写出
+            yield b"".join(tail + closing)
+    finally:
+        if not reader.done():
+            # Client gone: close the event source so its cleanup runs / 客户端已离开：关闭事件源以执行其清理逻辑
+            reader.cancel()
+        SSE_FRAMES.observe(frames)
+        SSE_BYTES.observe(sent_bytes)
+
+# --- Response Cache / 回复缓存 ---
+
+def canonical_message(msg):
+    """
+    [role, text, image reference hashes] for one message, independent of how the content is split into parts.
+    单条消息的 [角色, 文本, 图片引用哈希]，与内容如何拆分成多个部分无关。
+    """
+    content = msg.get("content", "")
+    if isinstance(content, str):
+        return [msg.get("role", "unknown"), content.strip(), []]
+    text_parts = []
+    image_hashes = []
+    for item in content or []:
+        if item.get("type") == "text":
+            text_parts.append(item.get("text", ""))
+        elif item.get("type") == "image_url":
+            url = item.get("image_url", {}).get("url", "")
+            image_hashes.append(hashlib.sha256(url.encode('utf-8')).hexdigest())
+    return [msg.get("role", "unknown"), "".join(text_parts).strip(), image_hashes]
+
+def request_fingerprint(messages, images, clean_json, response_format=None, early_stop=False):
+    """
+    Canonical hash of a request: message roles and text, a hash per image reference,
+    the content hash of every resolved image, clean_json, response_format, the JSON early stop and the chat mode.
+    请求的规范化哈希：消息角色与文本、每个图片引用的哈希、
+    每张已解析图片的内容哈希、clean_json、response_format、JSON 提前结束以及对话模式。
+    """
+    payload = {
+        "messages": [canonical_message(msg) for msg in messages],
+        "images": [hashlib.sha256(b64.encode('utf-8')).hexdigest() for b64, _ in images],
+        "clean_json": bool(clean_json),
+        "temporary_chat": USE_TEMPORARY_CHAT,
     }
+    if response_format:
+        payload["response_format"] = response_format
+    if early_stop:
+        # A truncated clean_json answer must not be replayed to a stream request / 截断的 clean_json 回复不能重放给流式请求
+        payload["json_early_stop"] = True
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache of raw Gemini answers: an in-memory LRU and an optional SQLite file.
+    Entries expire after `ttl` seconds. The raw text is stored so both the SSE and
+    the buffered (clean_json) paths can replay it.
+    两级 Gemini 原始回复缓存：内存 LRU 与可选的 SQLite 文件。
+    条目在 `ttl` 秒后过期。保存的是原始文本，因此 SSE 与缓冲 (clean_json) 两条路径都可以重放。
+    """
+    def __init__(self, ttl, max_entries, db_path=""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0}
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, completion_signal TEXT, expires_at REAL)")
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry and entry[0] < now:
+                del self._items[key]
+                entry = None
+            if entry is None and self._db:
+                row = self._db.execute("SELECT expires_at, content, completion_signal FROM responses WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+                if row:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1], entry[2]
+
+    def put(self, key, content, completion_signal):
+        entry = (time.time() + self.ttl, content, completion_signal)
+        with self._lock:
+            self._remember(key, entry)
+            self.stats["stores"] += 1
+            if self._db:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, content, completion_signal, entry[0]))
+                self._db.commit()
+
+    def _remember(self, key, entry):
+        self._items[key] = entry
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_DB) if RESPONSE_CACHE_ENABLED else None
+
+def cache_bypassed(request: Request):
+    """
+    Per-request opt-out: `Cache-Control: no-cache` / `no-store` or `X-Cache-Bypass: 1`.
+    单个请求跳过缓存：`Cache-Control: no-cache` / `no-store` 或 `X-Cache-Bypass: 1`。
+    """
+    cache_control = request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control or request.headers.get("x-cache-bypass", "") in ("1", "true")
+
+async def replay_cached(content, completion_signal):
+    yield (EVENT_DELTA, content)
+    yield (EVENT_DONE, completion_signal)
+
+async def store_on_success(events, key):
+    """
+    Pass events through unchanged and cache the answer if the turn finished without error.
+    An answer cut off by the generation timeout is incomplete and never cached.
+    原样转发事件，若本轮无错误完成则缓存回复。因生成超时而截断的回复并不完整，不会被缓存。
+    """
+    parts = []
+    failed = False
+    async for event in events:
+        kind, value = event
+        if kind == EVENT_DELTA:
+            parts.append(value)
+        elif kind == EVENT_ERROR:
+            failed = True
+        elif kind == EVENT_DONE and not failed and parts and value != "timeout":
+            # Store before forwarding: consumers stop reading at the done event
+            # 先存储再转发：消费者读到结束事件就会停止
+            response_cache.put(key, "".join(parts), value)
+        yield event
+
+# --- Single-Flight / 相同请求合并 ---
+
+class InFlight:
+    """
+    One running generation shared by every client that sent the same request.
+    Each subscriber gets all events from the start (replay), then the live ones.
+    由所有发送相同请求的客户端共享的一次生成。
+    每个订阅者先收到已产生的全部事件 (重放)，再接收实时事件。
+    """
+    def __init__(self, key, job, events):
+        self.key = key
+        self.job = job
+        self.history = []
+        self.subscribers = []
+        self.done = False
+        # Clients still waiting for this answer / 仍在等待该回复的客户端数
+        self.clients = 0
+        self.task = asyncio.create_task(self._pump(events))
+
+    def attach(self):
+        self.clients += 1
+
+    def detach(self, completed):
+        """
+        A client is done with this flight. When the last one leaves before the answer
+        finished, nobody needs it any more and the job is aborted.
+        某个客户端不再需要该请求。若最后一个客户端在回复完成前离开，
+        则已无人需要该回复，任务将被中止。
+        """
+        self.clients -= 1
+        if self.clients > 0 or self.done or completed:
+            return
+        # New identical requests must start a fresh generation / 新的相同请求必须重新开始生成
+        if in_flight.get(self.key) is self:
+            del in_flight[self.key]
+        scheduler.abort(self.job)
+
+    async def _pump(self, events):
+        try:
+            async for event in events:
+                self.history.append(event)
+                for subscriber in self.subscribers:
+                    subscriber.put_nowait(event)
+        finally:
+            self.done = True
+            for subscriber in self.subscribers:
+                subscriber.put_nowait(_JOB_DONE)
+            if in_flight.get(self.key) is self:
+                del in_flight[self.key]
+
+    async def subscribe(self):
+        subscriber = asyncio.Queue()
+        for event in self.history:
+            subscriber.put_nowait(event)
+        if self.done:
+            subscriber.put_nowait(_JOB_DONE)
+        else:
+            self.subscribers.append(subscriber)
+        completed = False
+        try:
+            while True:
+                event = await subscriber.get()
+                if event is _JOB_DONE: return
+                if event[0] != EVENT_DELTA:
+                    completed = True
+                yield event
+        finally:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            self.detach(completed)
+
+in_flight = {}
+flight_stats = {"started": 0, "joined": 0}
+
+# --- Conversation Affinity / 会话亲和 ---
+
+def message_prefix_hashes(messages):
+    """
+    Rolling hash over the conversation: entry i identifies messages[:i + 1].
+    会话的滚动哈希：第 i 项标识 messages[:i + 1]。
+    """
+    hashes = []
+    digest = b""
+    for msg in messages:
+        encoded = json.dumps(canonical_message(msg), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(digest + encoded).digest()
+        hashes.append(digest.hex())
+    return hashes
+
+class ConversationMap:
+    """
+    Persistent mapping from a conversation prefix hash to the Gemini chat holding it: its URL, the
+    number of messages, the profile (Google account) that owns it and the tab that last showed it.
+    `heads` remembers how many messages each chat currently has, so a prefix that the chat
+    has already moved past (retry, edited history) is not reused.
+    会话前缀哈希到对应 Gemini 对话的持久化映射：对话 URL、消息数、拥有该对话的配置 (Google 账号)
+    以及最后显示它的标签页。`heads` 记录每个对话当前包含的消息数，已被对话越过的前缀 (重试、修改历史) 不会被复用。
+    """
+    MAX_ENTRIES = 5000
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.heads = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.entries = data.get("entries", {})
+                self.heads = data.get("heads", {})
+            except Exception as e:
+                print(f"!!! Failed to load conversation map / 加载会话映射失败: {e}")
+
+    def lookup(self, prefix_hash):
+        with self._lock:
+            entry = self.entries.get(prefix_hash)
+            if entry and self.heads.get(entry["url"]) == entry["turns"]:
+                return entry
+            return None
+
+    def register(self, prefix_hash, url, turns, profile=None, tab=None):
+        with self._lock:
+            self.entries.pop(prefix_hash, None)
+            self.entries[prefix_hash] = {"url": url, "turns": turns, "profile": profile, "tab": tab}
+            self.heads[url] = turns
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.pop(next(iter(self.entries)))
+            self._save()
+
+    def _save(self):
+        if not self.path: return
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"entries": self.entries, "heads": self.heads}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"!!! Failed to save conversation map / 保存会话映射失败: {e}")
+
+conversation_map = ConversationMap(AFFINITY_STORE_PATH) if CONVERSATION_AFFINITY else None
+
+class ConversationPlan:
+    """
+    How one request maps onto Gemini: the chat to continue (None = new chat) and the
+    messages still to be typed. After the turn, the conversation including the answer is
+    registered so the next request can continue from it.
+    单个请求如何映射到 Gemini：要继续的对话 (None 表示新对话) 以及仍需输入的消息。
+    本轮结束后，包含回复在内的会话会被登记，下一次请求即可从此继续。
+    """
+    def __init__(self, messages, entry, start):
+        self.messages = messages
+        entry = entry or {}
+        self.chat_url = entry.get("url")
+        self.profile = entry.get("profile")
+        self.tab = entry.get("tab")
+        self.start = start
+        self.final_url = None
+        self.final_worker = None
+
+    @property
+    def affinity(self):
+        # Entries saved before profiles were recorded carry no owner / 记录配置之前保存的条目没有所属信息
+        return (self.profile, self.tab) if self.chat_url and self.profile else None
+
+    def prompt(self):
+        delta = self.messages[self.start:]
+        if len(delta) == 1 and delta[0].get("role") == "user":
+            return process_last_message_only(delta)
+        return process_full_conversation(delta)
+
+    def full_replay(self):
+        # The stored chat is gone: start over with the whole history in a new chat
+        # 已保存的对话不存在：在新对话中重新发送全部历史
+        self.start = 0
+        return process_full_conversation(self.messages)
+
+    def finished(self, url, worker):
+        # Called by the generator with the chat URL after the turn / 本轮结束后由生成器传入对话 URL
+        self.final_url = url
+        self.final_worker = worker
+
+    @property
+    def turns(self):
+        # Messages the chat holds once the answer is in / 回复写入后对话包含的消息数
+        return len(self.messages) + 1
+
+    def register_answer(self, answer):
+        if not self.final_url or not answer: return
+        conversation = self.messages + [{"role": "assistant", "content": answer}]
+        conversation_map.register(message_prefix_hashes(conversation)[-1], self.final_url, len(conversation),
+                                  self.final_worker.profile.name, self.final_worker.index)
+
+def plan_conversation(messages):
+    """
+    Find the longest known prefix of `messages` and plan to send only what comes after it.
+    找到 `messages` 中最长的已知前缀，并计划只发送其后的消息。
+    """
+    hashes = message_prefix_hashes(messages)
+    for k in range(len(messages) - 1, 0, -1):
+        entry = conversation_map.lookup(hashes[k - 1])
+        if entry:
+            print(f">>> [Affinity] Continuing chat, sending {len(messages) - k} new messages / 继续已有对话，发送 {len(messages) - k} 条新消息")
+            return ConversationPlan(messages, entry, k)
+    return ConversationPlan(messages, None, 0)
+
+async def record_conversation(events, plan):
+    """
+    Pass events through and register the raw answer once the turn finished without error.
+    原样转发事件，若本轮无错误完成则登记原始回复。
+    """
+    parts = []
+    failed = False
+    async for event in events:
+        kind, value = event
+        if kind == EVENT_DELTA:
+            parts.append(value)
+        elif kind == EVENT_ERROR:
+            failed = True
+        elif kind == EVENT_DONE and not failed:
+            plan.register_answer("".join(parts))
+        yield event
+
+def same_chat(url_a, url_b):
+    return (url_a or "").split("?")[0].rstrip("/") == (url_b or "").split("?")[0].rstrip("/")
 
 # --- Core Interaction Logic / 核心交互逻辑 ---
 
-def ensure_chat_mode():
+def ensure_chat_mode(tab):
     """
     Accurately switch chat modes based on configuration.
     根据配置，精准切换对话模式。
     """
     try:
-        temp_btn = page.ele('css:button[data-test-id="temp-chat-button"]', timeout=0.5)
+        temp_btn = tab.ele('css:button[data-test-id="temp-chat-button"]', timeout=0.5)
 
         if not temp_btn:
-            menu_btn = page.ele('css:button[data-test-id="side-nav-menu-button"]', timeout=2)
+            menu_btn = tab.ele('css:button[data-test-id="side-nav-menu-button"]', timeout=2)
             if menu_btn:
                 menu_btn.click()
-                temp_btn = page.ele('css:button[data-test-id="temp-chat-button"]', timeout=2)
+                temp_btn = tab.ele('css:button[data-test-id="temp-chat-button"]', timeout=2)
         
         if not temp_btn:
             print("!!! Critical: Cannot locate Temporary Chat button / 严重：无法定位临时对话按钮")
-            return
+            return False
 
         class_str = temp_btn.attr('class') or ""
         is_temp_on = "temp-chat-on" in class_str
@@ -369,90 +2685,207 @@ def ensure_chat_mode():
             print(">>> [Action] Disabling Temporary Chat / 关闭临时对话")
             temp_btn.click()
             time.sleep(0.5)
-        temp_btn = page.ele('css:button[data-test-id="temp-chat-button"]', timeout=0.3)
+        temp_btn = tab.ele('css:button[data-test-id="temp-chat-button"]', timeout=0.3)
         # Close menu / 关闭菜单
         if  temp_btn:
-            menu_btn = page.ele('css:button[data-test-id="side-nav-menu-button"]', timeout=2)
+            menu_btn = tab.ele('css:button[data-test-id="side-nav-menu-button"]', timeout=2)
             menu_btn.click()
             time.sleep(0.2)
+        return True
             
     except Exception as e:
         print(f"!!! Mode switch detection error / 模式切换检测出错: {e}")
+        return False
 
-def gemini_stream_generator(text_message: str, images: list):
-    check_login()
-    
+def prepare_fresh_page(tab, state):
+    """
+    Load a new chat and set the chat mode, off the request's critical path.
+    Returns True when the page is ready to take input; `state` then describes it fully.
+    在请求关键路径之外加载新对话并设置对话模式。
+    页面可以输入时返回 True，此时 `state` 完整描述该页面。
+    """
+    navigate(tab, TARGET_URL, "prewarm")
+    state.navigated(TARGET_URL)
+    if not tab.ele(INPUT_BOX_SELECTOR, timeout=10):
+        return False
+    if not ensure_chat_mode(tab):
+        return False
+    state.chat_mode = USE_TEMPORARY_CHAT
+    state.logged_in = True
+    # The mode switch may re-render the input box, so look it up afterwards
+    # 模式切换可能会重新渲染输入框，因此在切换后再获取
+    input_box = tab.ele(INPUT_BOX_SELECTOR, timeout=5)
+    if not input_box:
+        return False
+    state.mark(input_box)
+    return True
+
+def gemini_stream_generator(worker: TabWorker, text_message: str, images: list, conversation=None, structured=None):
+    timer = worker.timer
     # 1. Refresh/Navigate / 刷新/跳转页面
-    if USE_TEMPORARY_CHAT:
-        page.get(TARGET_URL)
-    elif "gemini.google.com" not in page.url:
-        page.get(TARGET_URL)
+    # A pre-warmed page is already on a fresh chat in the right mode
+    # 预热页面已处于正确模式下的新对话
+    warm = USE_TEMPORARY_CHAT and worker.take_warm_page()
+    tab = worker.tab
+    state = worker.state
+
+    if warm:
+        print(f">>> [Tab {worker.index}] Using pre-warmed page / 使用预热页面")
+        cached = state.verify(tab)
+    elif USE_TEMPORARY_CHAT:
+        navigate(tab, TARGET_URL, "request")
+        state.navigated(TARGET_URL)
+        cached = False
+    elif conversation is not None:
+        # Conversation affinity: continue the mapped chat, or start a new one
+        # 会话亲和：继续映射的对话，或开启新对话
+        cached = state.verify(tab)
+        foreign = conversation.profile is not None and conversation.profile != worker.profile.name
+        if conversation.chat_url is None or foreign:
+            if foreign:
+                # The chat belongs to another Google account, which is down or cooling down
+                # 该对话属于另一个 Google 账号，而该账号已失效或正在冷却
+                print(f">>> [Affinity] Chat owned by profile [{conversation.profile}], replaying full history / 对话属于其他配置，重新发送完整历史")
+                text_message, images = conversation.full_replay()
+                if structured:
+                    text_message += structured.instruction()
+            navigate(tab, TARGET_URL, "request")
+            state.navigated(TARGET_URL)
+            cached = False
+        elif not same_chat(state.url, conversation.chat_url) or state.chat_turns != conversation.start:
+            # Also reload when another tab moved the chat on since this tab last showed it
+            # 若自本标签页上次显示后对话已被其他标签页推进，同样重新加载
+            navigate(tab, conversation.chat_url, "request")
+            cached = False
+            if same_chat(tab.url, conversation.chat_url):
+                state.opened(conversation.chat_url)
+            else:
+                print(">>> [Affinity] Chat no longer available, replaying full history / 对话已不可用，重新发送完整历史")
+                state.navigated(tab.url)
+                text_message, images = conversation.full_replay()
+                if structured:
+                    text_message += structured.instruction()
+    else:
+        cached = state.verify(tab)
+        if TARGET_HOST not in state.url:
+            navigate(tab, TARGET_URL, "request")
+            state.navigated(TARGET_URL)
+    timer.mark("navigate")
 
     try:
-        # 2. Wait for UI readiness / 等待 UI 就绪
-        input_box = page.ele('css:div[contenteditable="true"][role="textbox"]', timeout=10)
-        
-        if not input_box:
-            page.refresh()
-            input_box = page.ele('css:div[contenteditable="true"][role="textbox"]', timeout=10)
-            if not input_box:
-                yield f"data: {json.dumps({'error': 'Input box not found'})}\n\n"
+        if cached:
+            # Steady state: reuse the known input box, mode and response count without any DOM lookups
+            # 稳定状态：直接复用已知的输入框、模式与回复数量，无需任何 DOM 查询
+            input_box = state.input_box
+            prev_count = state.response_count
+        else:
+            if not check_login(tab, state):
+                state.invalidate()
+                yield (EVENT_ERROR, f'Login required: redirected to {tab.url}')
                 return
 
-        # 3. Confirm Mode / 确认模式
-        ensure_chat_mode()
+            # 2. Wait for UI readiness / 等待 UI 就绪
+            input_box = state.input_box or tab.ele(INPUT_BOX_SELECTOR, timeout=10)
+            
+            if not input_box:
+                tab.refresh()
+                state.navigated(TARGET_URL)
+                input_box = tab.ele(INPUT_BOX_SELECTOR, timeout=10)
+                if not input_box:
+                    yield (EVENT_ERROR, 'Input box not found')
+                    return
 
-        # 4. Get input box again / 再次获取输入框
-        input_box = page.ele('css:div[contenteditable="true"][role="textbox"]', timeout=2)
-        if not input_box: 
-             input_box = page.ele('css:div[contenteditable="true"][role="textbox"]', timeout=5)
-        
-        # Optimization: Fast detection of history messages / 优化：快速检测历史消息
-        prev_chunks = page.eles('css:.model-response-text', timeout=0.5)
-        if not prev_chunks:
-            prev_chunks = page.eles('css:[data-message-id]', timeout=0.5)
-        prev_count = len(prev_chunks)
+            if state.chat_mode != USE_TEMPORARY_CHAT:
+                # 3. Confirm Mode / 确认模式
+                if ensure_chat_mode(tab):
+                    state.chat_mode = USE_TEMPORARY_CHAT
+
+                # 4. Get input box again / 再次获取输入框
+                input_box = tab.ele(INPUT_BOX_SELECTOR, timeout=2)
+                if not input_box: 
+                     input_box = tab.ele(INPUT_BOX_SELECTOR, timeout=5)
+            
+            if state.response_count is None:
+                # Optimization: Fast detection of history messages / 优化：快速检测历史消息
+                prev_chunks = tab.eles('css:.model-response-text', timeout=0.5)
+                if not prev_chunks:
+                    prev_chunks = tab.eles('css:[data-message-id]', timeout=0.5)
+                state.response_count = len(prev_chunks)
+            prev_count = state.response_count
+            state.mark(input_box)
+        timer.mark("prepare")
 
         # 5. Upload Images / 上传图片
         if images:
             print(f">>> Preparing to inject {len(images)} images... / 准备注入 {len(images)} 张图片...")
-            for b64, mime in images:
-                script = js_paste_image(b64, mime)
-                result = page.run_js(script)
-                if result == "success":
-                    print(">>> JS Paste Success / JS 粘贴成功")
-                    time.sleep(2.5) 
-                else:
-                    yield f"data: {json.dumps({'error': f'Image upload failed: {result}'})}\n\n"
-                    return
+            upload_start = time.time()
+            existing_previews = count_upload_previews(tab)
+            result = paste_images(tab, images)
+            if result != "success":
+                state.invalidate()
+                yield (EVENT_ERROR, f'Image upload failed: {result}')
+                return
+            if not wait_for_uploads(tab, existing_previews + len(images)):
+                state.invalidate()
+                yield (EVENT_ERROR, 'Image upload timed out')
+                return
+            print(f">>> JS Paste Success / JS 粘贴成功 ({len(images)} images, {time.time() - upload_start:.2f}s)")
+            timer.mark("upload")
+
+        listening = start_completion_listener(tab)
 
         # 6. Input Text / 输入文本
         if text_message:
-            input_box.input(text_message)
+            if PROMPT_ATTACH_THRESHOLD and len(text_message) > PROMPT_ATTACH_THRESHOLD:
+                print(f">>> Prompt too long ({len(text_message)} chars), attaching as file / 提示词过长，改为附件发送")
+                result = attach_prompt_file(tab, text_message)
+                if result != "success":
+                    state.invalidate()
+                    yield (EVENT_ERROR, f'Prompt attachment failed: {result}')
+                    return
+                text_message = PROMPT_ATTACHMENT_NOTE
+            insert_prompt(input_box, text_message)
         time.sleep(0.1)
 
-        send_btn = page.ele('css:button[aria-label*="Send"]', timeout=2)
+        if worker.abort.is_set():
+            # Client left before anything was sent / 发送前客户端已离开
+            state.invalidate()
+            return
+
+        send_btn = tab.ele('css:button[aria-label*="Send"]', timeout=2)
         if send_btn:
             send_btn.click()
         else:
             input_box.input('\n')
+        timer.mark("input")
 
         # 7. Wait for Response / 等待响应
         last_response_ele = None
         wait_start = time.time()
         
         while True:
+            if worker.abort.is_set():
+                stop_generation(tab)
+                state.invalidate()
+                return
+
             if time.time() - wait_start > 120:
-                yield f"data: {json.dumps({'error': 'Timeout'})}\n\n"
+                state.invalidate()
+                yield (EVENT_ERROR, 'Timeout')
                 return
 
             if int(time.time() * 10) % 5 == 0:
-                error_toast = page.ele('text:出现了点问题', timeout=0.01) or page.ele('css:.error-message', timeout=0.01)
+                error_toast = tab.ele('text:出现了点问题', timeout=0.01) or tab.ele('css:.error-message', timeout=0.01)
                 if error_toast:
-                    yield f"data: {json.dumps({'error': f'Gemini Error: {error_toast.text}'})}\n\n"
+                    state.invalidate()
+                    toast_text = error_toast.text
+                    if any(marker in toast_text.lower() for marker in RATE_LIMIT_MARKERS):
+                        yield (EVENT_ERROR, f'Rate limited: {toast_text}')
+                    else:
+                        yield (EVENT_ERROR, f'Gemini Error: {toast_text}')
                     return
 
-            current_chunks = page.eles('css:.model-response-text') or page.eles('css:[data-message-id]')
+            current_chunks = tab.eles('css:.model-response-text') or tab.eles('css:[data-message-id]')
             
             if current_chunks and len(current_chunks) > prev_count:
                 last_response_ele = current_chunks[-1]
@@ -462,55 +2895,190 @@ def gemini_stream_generator(text_message: str, images: list):
                 last_response_ele = current_chunks[-1]
                 break
             time.sleep(0.1)
+        timer.mark("first_response")
 
         # 8. Robust Stream Transmission / 稳健流式传输
         last_text = ""
+        sent_len = 0
         start_time = time.time()
-        resp_id = f"chatcmpl-{int(time.time())}"
         stable_count = 0 
-        REQUIRED_STABLE_COUNT = 15
+        use_observer = STREAM_MODE == "observer" and install_stream_observer(last_response_ele, 0)
+        # Draining the observer is one cheap call, so it can run more often than a full text read.
+        # 取走观察器缓冲只需一次轻量调用，因此可以比读取全文更频繁。
+        poll_interval = 0.03 if use_observer else 0.1
+        # Once a completion signal fires, only a short settle window is needed for the last render.
+        # Without any signal, fall back to the old ~1.5 s stability window.
+        # 一旦出现完成信号，只需短暂等待最后一次渲染；没有任何信号时回退到原先约 1.5 秒的稳定窗口。
+        SETTLE_COUNT = max(1, int(0.3 / poll_interval))
+        REQUIRED_STABLE_COUNT = int(1.5 / poll_interval)
+        completion_signal = None
+        stop_seen = False
+        # Structured requests are buffered until the first JSON value closes, then Gemini is stopped
+        # 结构化请求会缓冲到第一个 JSON 值闭合，随后停止 Gemini 生成
+        extractor = JsonExtractor(structured.opener) if structured else None
+        last_delta_at = None
         
         while True:
-            if time.time() - start_time > 130: break
-            try:
-                current_text = last_response_ele.text 
-            except:
-                chunks = page.eles('css:.model-response-text') or page.eles('css:[data-message-id]')
-                if chunks: last_response_ele = chunks[-1]
-                current_text = last_text
+            if worker.abort.is_set():
+                # Nobody is reading any more: stop Gemini and free the tab
+                # 已无人读取：停止 Gemini 并释放标签页
+                stop_generation(tab)
+                state.invalidate()
+                return
+            if time.time() - start_time > MAX_RESPONSE_SECONDS:
+                completion_signal = "timeout"
+                break
+            delta = ""
+            if use_observer:
+                try:
+                    delta, alive = drain_stream_observer(tab)
+                except Exception:
+                    alive = False
+                if not alive:
+                    # Response element re-rendered: observe the new one, skipping text already sent
+                    # 回复元素被重新渲染：观察新元素，跳过已发送的文本
+                    chunks = tab.eles('css:.model-response-text') or tab.eles('css:[data-message-id]')
+                    if chunks: last_response_ele = chunks[-1]
+                    use_observer = install_stream_observer(last_response_ele, sent_len)
+            else:
+                try:
+                    current_text = last_response_ele.text 
+                except:
+                    chunks = tab.eles('css:.model-response-text') or tab.eles('css:[data-message-id]')
+                    if chunks: last_response_ele = chunks[-1]
+                    current_text = last_text
+                if len(current_text) > len(last_text):
+                    delta = current_text[len(last_text):]
+                    last_text = current_text
 
-            if len(current_text) > len(last_text):
+            if delta:
                 stable_count = 0
-                delta = current_text[len(last_text):]
-                last_text = current_text
-                chunk_data = {
-                    "id": resp_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": "gemini-web-vision",
-                    "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+                sent_len += len(delta)
+                last_delta_at = time.perf_counter()
+                if extractor is None:
+                    yield (EVENT_DELTA, delta)
+                elif extractor.feed(delta):
+                    stopped = stop_generation(tab)
+                    print(f">>> [Tab {worker.index}] JSON complete, {'stopped generation' if stopped else 'generation already finished'} / JSON 已完整{'，已停止生成' if stopped else ''}")
+                    completion_signal = "json_complete"
+                    break
             else:
-                stop_btn = page.ele('css:button[aria-label="Stop responding"]', timeout=0.01)
-                if stop_btn: stable_count = 0
-                else: stable_count += 1
+                stable_count += 1
+                if completion_signal is None:
+                    completion_signal, stop_visible = detect_completion(tab, last_response_ele, listening, stop_seen)
+                    if stop_visible:
+                        stop_seen = True
+                        stable_count = 0
             
-            if len(current_text) > 0 and stable_count > REQUIRED_STABLE_COUNT:
-                break
-            time.sleep(0.1) 
+            if sent_len > 0:
+                if completion_signal and stable_count >= SETTLE_COUNT:
+                    break
+                if stable_count > REQUIRED_STABLE_COUNT:
+                    completion_signal = "stable"
+                    break
+            time.sleep(poll_interval)
 
-        yield f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
-        yield "data: [DONE]\n\n"
+        # "stream" ends with the last text change; "settle" is the completion tail after it
+        # "stream" 在最后一次文本变化时结束；"settle" 为其后的结束等待
+        timer.mark("stream", at=last_delta_at)
+        timer.mark("settle")
+        state.response_count = prev_count + 1
+        if conversation is not None:
+            state.url = tab.url
+            state.chat_turns = conversation.turns
+            conversation.finished(state.url, worker)
+        print(f">>> [Tab {worker.index}] Turn complete / 回复结束 | Signal: {completion_signal} | State: {'cached' if cached else 'rebuilt'}")
+        print(f">>> [Tab {worker.index}] Phases / 阶段耗时: {timer.report()}")
+        if extractor is not None:
+            if extractor.complete:
+                error = structured.validate(extractor.value)
+                if error and structured.strict:
+                    yield (EVENT_ERROR, f"Response does not match schema: {error}")
+                    return
+                if error:
+                    print(f"!!! [Structured] Schema mismatch / 不符合 schema: {error}")
+                yield (EVENT_DELTA, extractor.text)
+            elif structured.strict:
+                yield (EVENT_ERROR, "No JSON value found in the response")
+                return
+            elif extractor.raw:
+                # No JSON in the answer: pass the raw text on (clean_json repair still applies)
+                # 回复中没有 JSON：原样传递文本 (clean_json 修复仍然适用)
+                yield (EVENT_DELTA, extractor.raw)
+        yield (EVENT_DONE, completion_signal)
 
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        state.invalidate()
+        yield (EVENT_ERROR, str(e))
+
+# Toast wording that means the account hit a usage limit / 表示账号达到使用上限的提示文字
+RATE_LIMIT_MARKERS = ("limit", "too many", "try again later", "上限", "太多", "稍后再试")
+
+def check_login(tab, state):
+    """
+    False when the tab was redirected to the Google sign-in page.
+    标签页被跳转到 Google 登录页时返回 False。
+    """
+    state.logged_in = "accounts.google.com" not in (tab.url or "")
+    return state.logged_in
+
+def reset_job(worker):
+    ensure_chat_mode(worker.tab)
+    yield from ()
+
+def parse_scheduling_headers(request: Request):
+    """
+    Read X-Priority (higher runs first) and X-Request-Timeout (seconds) headers.
+    读取 X-Priority (越大越先执行) 与 X-Request-Timeout (秒) 请求头。
+    """
+    try: priority = int(request.headers.get("x-priority", 0))
+    except ValueError: priority = 0
+    try: timeout = float(request.headers.get("x-request-timeout", QUEUE_TIMEOUT))
+    except ValueError: timeout = QUEUE_TIMEOUT
+    return priority, timeout
+
+async def build_prompt(messages):
+    """
+    Prompt text, images and conversation plan (or None) for the current chat mode.
+    按当前对话模式生成提示词文本、图片与会话计划 (或 None)。
+    """
+    # Image download is blocking I/O, keep it off the event loop
+    # 图片下载是阻塞 I/O，不在事件循环中执行
+    plan = None
+    if USE_TEMPORARY_CHAT:
+        full_prompt, images = await asyncio.to_thread(process_full_conversation, messages)
+    elif CONVERSATION_AFFINITY:
+        plan = plan_conversation(messages)
+        full_prompt, images = await asyncio.to_thread(plan.prompt)
+    else:
+        full_prompt, images = await asyncio.to_thread(process_last_message_only, messages)
+    return full_prompt, images, plan
 
-def check_login():
-    if "accounts.google.com" in page.url: pass
+# Seconds between client-disconnect checks while a request is waiting / 请求等待期间检查客户端断开的间隔 (秒)
+DISCONNECT_POLL_INTERVAL = 0.5
+
+async def unless_disconnected(request: Request, awaitable):
+    """
+    Await `awaitable`, but give up as soon as the client closes the connection.
+    Returns (True, result), or (False, None) when the client is gone.
+    等待 `awaitable`，但客户端一旦关闭连接就立即放弃。
+    返回 (True, 结果)；客户端已离开时返回 (False, None)。
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return True, task.result()
+            if await request.is_disconnected():
+                return False, None
+    finally:
+        if not task.done():
+            task.cancel()
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
+    started_at = time.perf_counter()
     try: data = await request.json()
     except: return {"error": "Invalid JSON body"}
         
@@ -519,48 +3087,572 @@ async def chat_completions(request: Request):
     # Get clean_json param, default is True (Compatible with Browser-use)
     # 获取 clean_json 参数，默认为 True (保持 Browser-use 兼容)
     clean_json = data.get("clean_json", True)
+    response_format = data.get("response_format")
+    structured = parse_response_format(data, clean_json, is_stream)
+    early_stop = structured is not None and structured.source == "clean_json"
+    # OpenAI stream option: append a usage chunk before [DONE] / OpenAI 流式选项：在 [DONE] 之前附加 usage 数据块
+    include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
 
     if not messages: return {"error": "No messages"}
+    if startup_report["status"] == "failed":
+        return JSONResponse(status_code=503, content={"error": f"Browser startup failed: {startup_report['error']}"})
     
     print(f">>> Request Received | Stream: {is_stream} | Clean JSON: {clean_json} | Temp Chat: {USE_TEMPORARY_CHAT}")
     print(f">>> 收到请求 | 流式: {is_stream} | 清洗JSON: {clean_json} | 临时会话: {USE_TEMPORARY_CHAT}")
     
-    if USE_TEMPORARY_CHAT:
-        full_prompt, images = process_full_conversation(messages)
+    full_prompt, images, plan = await build_prompt(messages)
+    images_seconds = time.perf_counter() - started_at
+    PHASE_SECONDS.observe(images_seconds, phase="images")
+    mode = "stream" if is_stream else "buffered"
+
+    is_reset = full_prompt.strip() == "/reset"
+    if is_reset:
+        job_run = reset_job
     else:
-        full_prompt, images = process_last_message_only(messages)
+        if structured:
+            full_prompt += structured.instruction()
+        job_run = lambda worker: gemini_stream_generator(worker, full_prompt, images, conversation=plan, structured=structured)
 
-    if full_prompt.strip() == "/reset":
-         try:
-            ensure_chat_mode()
-            if not is_stream:
-                return {"id": "reset", "choices": [{"index": 0, "message": {"role": "assistant", "content": "对话已重置 / Chat Reset"}, "finish_reason": "stop"}]}
-            else:
-                 return StreamingResponse(iter([f"data: {json.dumps({'choices': [{'delta': {'content': '对话已重置 / Chat Reset'}}]})}\n\n", "data: [DONE]\n\n"]), media_type="text/event-stream")
-         except: pass
+    # Response cache: identical requests are answered without touching the browser
+    # 回复缓存：完全相同的请求无需访问浏览器即可返回
+    cache_key = None
+    cache_status = "OFF"
+    if response_cache and not is_reset:
+        if cache_bypassed(request):
+            response_cache.stats["bypassed"] += 1
+            cache_status = "BYPASS"
+        else:
+            cache_key = request_fingerprint(messages, images, clean_json, response_format, early_stop)
+            cached = response_cache.get(cache_key)
+            cache_status = "HIT" if cached else "MISS"
+            if cached:
+                print(">>> [Cache] Hit, replaying cached response / 命中缓存，重放缓存回复")
+                headers = {"X-Cache": cache_status}
+                events = instrument_events(replay_cached(*cached), started_at, "cache", mode)
+                if is_stream:
+                    return StreamingResponse(sse_stream(events, include_usage, len(full_prompt)), media_type="text/event-stream", headers=headers)
+                response_json = await collect_stream_content(events, clean_json=clean_json)
+                return JSONResponse(response_json, headers=headers)
 
-    if browser_lock.acquire(timeout=300):
+    # Single-flight: attach to an identical request that is already queued or running
+    # 相同请求合并：加入已在排队或运行中的相同请求
+    flight_key = None if is_reset else (cache_key or request_fingerprint(messages, images, clean_json, response_format, early_stop))
+    flight = in_flight.get(flight_key) if flight_key else None
+    joined = flight is not None
+    priority, timeout = parse_scheduling_headers(request)
+    deadline = None if timeout is None else time.time() + timeout
+    if joined:
+        print(">>> [Single-Flight] Joining identical in-flight request / 加入相同的进行中请求")
+        flight_stats["joined"] += 1
+        job = flight.job
+    else:
+        # Admission control: reject immediately when the queue is full
+        # 准入控制：队列已满时立即拒绝
         try:
-            generator = gemini_stream_generator(full_prompt, images)
-            if is_stream:
-                # Stream mode usually returns raw data directly
-                # 流式模式通常直接返回原始数据
-                return StreamingResponse(generator, media_type="text/event-stream")
-            else:
-                print(">>> Buffering full response in background... / 正在后台缓冲完整响应...")
-                # Pass clean_json parameter
-                # 传入 clean_json 参数
-                response_json = await collect_stream_content(generator, clean_json=clean_json)
-                print(f">>> Sending response to Client (Length: {len(response_json['choices'][0]['message']['content'])})")
-                return response_json
+            job = scheduler.submit(job_run, priority=priority, timeout=timeout, affinity=plan.affinity if plan else None)
+        except QueueFullError as e:
+            print(f"!!! Queue full, request rejected / 队列已满，拒绝请求 (Retry-After {e.retry_after}s)")
+            ERRORS.inc(kind="queue_full")
+            return JSONResponse(status_code=429, content={"error": "Queue full"}, headers={"Retry-After": str(e.retry_after)})
+        if flight_key:
+            events = job.stream()
+            if cache_key:
+                events = store_on_success(events, cache_key)
+            if plan:
+                events = record_conversation(events, plan)
+            flight = InFlight(flight_key, job, events)
+            in_flight[flight_key] = flight
+            flight_stats["started"] += 1
+    if flight:
+        flight.attach()
+
+    connected, started = await unless_disconnected(request, job.wait_started(deadline))
+    if not connected:
+        print(">>> Client disconnected while queued / 客户端在排队期间断开")
+        if flight: flight.detach(False)
+        else: scheduler.abort(job)
+        return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+    if job.error:
+        if flight: flight.detach(False)
+        return JSONResponse(status_code=503, content={"error": job.error})
+    if not started:
+        # A shared job is only dropped once no client waits for it any more (InFlight.detach)
+        # 共享任务只有在不再有客户端等待时才会被移除 (InFlight.detach)
+        if flight:
+            flight.detach(False)
+            gave_up = True
+        else:
+            gave_up = scheduler.cancel(job) or job.cancelled
+        if gave_up:
+            retry_after = scheduler.retry_after()
+            print(f"!!! Queue wait timed out / 排队超时 (Retry-After {retry_after}s)")
+            ERRORS.inc(kind="queue_timeout")
+            return JSONResponse(status_code=503, content={"error": "Browser Busy"}, headers={"Retry-After": str(retry_after)})
+    print(f">>> [Tab {job.worker.index}] Request dispatched / 请求已分配")
+
+    if is_reset:
+        async for _ in job.stream(): pass
+        if not is_stream:
+            return {"id": "reset", "choices": [{"index": 0, "message": {"role": "assistant", "content": "对话已重置 / Chat Reset"}, "finish_reason": "stop"}]}
+        else:
+            return StreamingResponse(iter([f"data: {json.dumps({'choices': [{'delta': {'content': '对话已重置 / Chat Reset'}}]})}\n\n", "data: [DONE]\n\n"]), media_type="text/event-stream")
+
+    events = instrument_events(flight.subscribe(), started_at, "joined" if joined else "browser", mode)
+    headers = {"X-Cache": cache_status, "X-Single-Flight": "JOINED" if joined else "LEADER"}
+    try:
+        if is_stream:
+            # Stream mode usually returns raw data directly
+            # The tab stays owned by the job until the generator is finished
+            # 流式模式通常直接返回原始数据
+            # 在生成器结束前，标签页一直归该任务所有
+            return StreamingResponse(sse_stream(events, include_usage, len(full_prompt)), media_type="text/event-stream", headers=headers)
+        else:
+            print(">>> Buffering full response in background... / 正在后台缓冲完整响应...")
+            # Pass clean_json parameter
+            # 传入 clean_json 参数
+            connected, response_json = await unless_disconnected(request, collect_stream_content(events, clean_json=clean_json))
+            if not connected:
+                # Cancelling the collector closes the subscription, which aborts the job if no one else waits
+                # 取消收集协程会关闭订阅；若无其他等待者，任务随之中止
+                print(">>> Client disconnected, response discarded / 客户端已断开，丢弃回复")
+                return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+            if plan and not joined:
+                # The client sends back the cleaned answer as history, map that version too
+                # 客户端会把清洗后的回复作为历史发回，因此也登记该版本
+                plan.register_answer(response_json['choices'][0]['message']['content'])
+            print(f">>> Sending response to Client (Length: {len(response_json['choices'][0]['message']['content'])})")
+            if SERVER_TIMING:
+                headers["Server-Timing"] = job.timer.server_timing([("images", images_seconds)])
+            return JSONResponse(response_json, headers=headers)
+    except GenerationError as e:
+        print(f"!!! Generation failed / 生成失败: {e}")
+        return JSONResponse(status_code=502, content={"error": str(e)}, headers=headers)
+    except Exception as e:
+        print(f"!!! Error processing request / 处理请求出错: {e}")
+        return {"error": str(e)}
+
+# Scrape-time views of existing state / 抓取时读取已有状态
+Gauge("webai_queue_depth", "Requests waiting for a tab", read=lambda: {(): scheduler.queue_depth})
+Gauge("webai_busy_tabs", "Tabs currently serving a request", read=lambda: {(): tab_pool.busy_count})
+Gauge("webai_tabs", "Worker tabs", read=lambda: {(): len(tab_pool)})
+Gauge("webai_profile_available", "1 if the profile is in rotation, 0 while cooling down", ("profile",),
+      read=lambda: {(profile.name,): int(profile.available()) for profile in browser_profiles})
+Counter("webai_profile_requests_total", "Requests finished per profile and result", ("profile", "result"),
+        read=lambda: {(profile.name, result): count for profile in browser_profiles for result, count in profile.stats.items()})
+Gauge("webai_in_flight", "Distinct generations currently shared by single-flight", read=lambda: {(): len(in_flight)})
+Counter("webai_response_cache_total", "Response cache lookups by result", ("result",),
+        read=lambda: {(result,): count for result, count in response_cache.stats.items()} if response_cache else {})
+Counter("webai_single_flight_total", "Generations started and requests joined", ("role",),
+        read=lambda: {(role,): count for role, count in flight_stats.items()})
+
+Gauge("webai_startup_seconds", "Cold start durations: browser launch, first page load, process start to ready", ("profile", "stage"),
+      read=lambda: {**{(name, stage.removesuffix("_seconds")): value for name, timings in startup_report["profiles"].items() for stage, value in timings.items()},
+                    **({("all", "ready"): startup_report["ready_seconds"]} if startup_report["ready_seconds"] is not None else {})})
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def ready():
+    # Readiness probe: 200 once the browsers are up and requests are being dispatched / 就绪探针：浏览器启动完成并开始分配请求后返回 200
+    body = {"ready": startup_report["status"] == "ready", **startup_report}
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "tabs": len(tab_pool),
+        "busy_tabs": tab_pool.busy_count,
+        "profiles": [profile.health() for profile in browser_profiles],
+        "queued": scheduler.queue_depth,
+        "response_cache": response_cache.stats if response_cache else None,
+        "single_flight": {**flight_stats, "in_flight": len(in_flight)},
+    }
+
+# --- Batch Jobs / 批处理任务 ---
+
+BATCH_ITEMS = Counter("webai_batch_items_total", "Batch items by result (retried counts each retry)", ("result",))
+
+def batch_custom_id(item, line_no):
+    # OpenAI batch lines carry a custom_id; bare request bodies are named after their line
+    # OpenAI 批处理行带有 custom_id；裸请求体以行号命名
+    return str(item.get("custom_id") or f"line-{line_no}")
+
+def resolve_batch_path(path):
+    """
+    Absolute path of a batch file inside BATCH_DIR, or None when it points anywhere else.
+    Relative paths are taken relative to BATCH_DIR.
+    BATCH_DIR 内批处理文件的绝对路径；指向其他位置时返回 None。相对路径以 BATCH_DIR 为基准。
+    """
+    if not isinstance(path, str) or not path: return None
+    resolved = os.path.realpath(os.path.join(BATCH_DIR, path))
+    if os.path.commonpath([resolved, BATCH_DIR]) != BATCH_DIR or resolved == BATCH_DIR: return None
+    return resolved
+
+# Every result line starts like this, see BatchJob._process / 每个结果行都以此开头，见 BatchJob._process
+BATCH_RESULT_PREFIX = b'{"id": "batch_req_'
+
+def read_batch_output(path, drop_failed=False):
+    """
+    custom_ids already written to an output file. Raises ValueError when a complete line is not a batch
+    result, so no other file is ever modified. A last line cut off by a crash is truncated away;
+    with drop_failed, failed results are removed so those items run again.
+    输出文件中已写入的 custom_id。若某个完整行不是批处理结果则抛出 ValueError，从而绝不修改其他文件。
+    崩溃导致的不完整末行会被截掉；drop_failed 为真时会移除失败的结果，使这些条目重新执行。
+    """
+    done = set()
+    if not os.path.exists(path): return done
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    partial = lines.pop() if lines and not lines[-1].endswith(b"\n") else None
+    kept = []
+    for line_no, line in enumerate(lines, 1):
+        try:
+            result = json.loads(line)
+            custom_id = result["custom_id"] if line.startswith(BATCH_RESULT_PREFIX) else None
+        except (ValueError, KeyError, TypeError):
+            custom_id = None
+        if not isinstance(custom_id, str):
+            raise ValueError(f"{path} line {line_no} is not a batch result, refusing to resume into this file")
+        if drop_failed and result.get("error"): continue
+        done.add(custom_id)
+        kept.append(line)
+    if partial is not None and not partial.startswith(BATCH_RESULT_PREFIX):
+        raise ValueError(f"{path} does not end with a batch result, refusing to resume into this file")
+    if len(kept) != len(lines):
+        # Every line is ours, so the failures can be dropped; replace the file atomically
+        # 每一行都由批处理写入，可以移除失败结果；以原子方式替换文件
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(kept)
+        os.replace(tmp, path)
+    elif partial is not None:
+        with open(path, "r+b") as f:
+            f.truncate(sum(len(line) for line in lines))
+    return done
+
+async def run_batch_item(body):
+    """
+    One chat completion through the normal browser pipeline (prompt building, response cache,
+    scheduler, conversation affinity). Returns the same body as a non-stream request.
+    通过常规浏览器流程 (构建提示词、回复缓存、调度器、会话亲和) 执行一次对话补全。
+    返回与非流式请求相同的响应体。
+    """
+    started_at = time.perf_counter()
+    messages = body.get("messages") or []
+    if not messages: raise ValueError("No messages")
+    if startup_report["status"] == "failed":
+        raise GenerationError(f"Browser startup failed: {startup_report['error']}")
+    clean_json = body.get("clean_json", True)
+    structured = parse_response_format(body, clean_json)
+    early_stop = structured is not None and structured.source == "clean_json"
+    full_prompt, images, plan = await build_prompt(messages)
+    if structured:
+        full_prompt += structured.instruction()
+
+    cache_key = None
+    if response_cache:
+        cache_key = request_fingerprint(messages, images, clean_json, body.get("response_format"), early_stop)
+        cached = response_cache.get(cache_key)
+        if cached:
+            events = instrument_events(replay_cached(*cached), started_at, "cache", "batch")
+            return await collect_stream_content(events, clean_json=clean_json)
+
+    job_run = lambda worker: gemini_stream_generator(worker, full_prompt, images, conversation=plan, structured=structured)
+    job = scheduler.submit(job_run, priority=BATCH_PRIORITY, affinity=plan.affinity if plan else None)
+    events = job.stream()
+    if cache_key:
+        events = store_on_success(events, cache_key)
+    if plan:
+        events = record_conversation(events, plan)
+    try:
+        response_json = await collect_stream_content(instrument_events(events, started_at, "browser", "batch"), clean_json=clean_json)
+    except asyncio.CancelledError:
+        # Batch cancelled: give the tab back instead of finishing the answer
+        # 批处理被取消：归还标签页而不是继续生成
+        scheduler.abort(job)
+        raise
+    if plan:
+        plan.register_answer(response_json['choices'][0]['message']['content'])
+    return response_json
+
+class BatchJob:
+    """
+    An OpenAI-style batch: chat completion requests read from a JSONL file and answered into
+    another JSONL file, one line per request as soon as it finishes. The output file is the
+    checkpoint: resuming skips every custom_id already in it. Options live next to it in
+    `<output>.checkpoint.json`.
+    OpenAI 风格的批处理：从 JSONL 文件读取对话补全请求，每个请求完成后立即向另一个 JSONL 文件写入一行。
+    输出文件本身就是检查点：恢复时跳过其中已有的所有 custom_id。选项保存在旁边的 `<output>.checkpoint.json` 中。
+    """
+    def __init__(self, input_file, output_file, max_retries=BATCH_MAX_RETRIES, retry_backoff=BATCH_RETRY_BACKOFF,
+                 concurrency=0, retry_failed=False, batch_id=None, created_at=None):
+        self.id = batch_id or f"batch_{uuid.uuid4().hex[:24]}"
+        self.input_file = input_file
+        self.output_file = output_file
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.concurrency = concurrency
+        self.retry_failed = retry_failed
+        self.status = "validating"
+        self.created_at = created_at or int(time.time())
+        self.in_progress_at = None
+        self.completed_at = None
+        self.counts = {"total": 0, "completed": 0, "failed": 0, "skipped": 0}
+        self.retried = 0
+        self.error = None
+        self.task = None
+        self._items = set()
+        self._started = None
+        # First exception that escaped an item task / 首个从条目任务中逃逸的异常
+        self._crash = None
+        # Checkpoints are written from worker threads / 检查点会在工作线程中写入
+        self._checkpoint_lock = threading.Lock()
+
+    @property
+    def checkpoint_file(self):
+        return self.output_file + ".checkpoint.json"
+
+    def limit(self):
+        # Enough items to keep every tab busy with one more ready behind it
+        # 足以让每个标签页都有任务，并各有一个在后面等待
+        return self.concurrency or BATCH_CONCURRENCY or max(1, len(tab_pool)) * 2
+
+    def to_dict(self):
+        finished = self.counts["completed"] + self.counts["failed"]
+        elapsed = (self.completed_at or time.time()) - self._started if self._started else 0
+        rate = finished / elapsed if elapsed and finished else None
+        remaining = self.counts["total"] - self.counts["skipped"] - finished
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": self.status,
+            "input_file": self.input_file,
+            "output_file": self.output_file,
+            "created_at": self.created_at,
+            "in_progress_at": self.in_progress_at,
+            "completed_at": self.completed_at,
+            "errors": self.error,
+            "request_counts": dict(self.counts),
+            "options": {"max_retries": self.max_retries, "retry_backoff": self.retry_backoff, "concurrency": self.limit()},
+            "progress": {
+                "running": len(self._items),
+                "retried": self.retried,
+                "items_per_minute": round(rate * 60, 2) if rate else None,
+                "eta_seconds": round(remaining / rate) if rate and self.status == "in_progress" else None,
+            },
+        }
+
+    def checkpoint_state(self):
+        return {key: value for key, value in self.to_dict().items() if key not in ("progress", "errors")}
+
+    def save_checkpoint(self, state=None):
+        state = state or self.checkpoint_state()
+        with self._checkpoint_lock:
+            tmp = self.checkpoint_file + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.checkpoint_file)
+
+    def _persist(self, out, state):
+        # One fsync per item is negligible next to a browser turn, and keeps the checkpoint exact after a crash
+        # 与一次浏览器回复相比，每条一次 fsync 的开销可以忽略，却能保证崩溃后检查点准确
+        os.fsync(out.fileno())
+        self.save_checkpoint(state)
+
+    def _item_done(self, task, slots):
+        self._items.discard(task)
+        slots.release()
+        if not task.cancelled() and task.exception() is not None and self._crash is None:
+            # The item wrote no result line; fail the batch rather than report it completed
+            # 该条目没有写入结果行；令批处理失败，而不是报告为已完成
+            self._crash = task.exception()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        if self.status == "in_progress":
+            self.status = "cancelling"
+            self.task.cancel()
+
+    async def _run(self):
+        try:
+            done = read_batch_output(self.output_file, drop_failed=self.retry_failed)
+            with open(self.input_file, "r", encoding="utf-8") as f:
+                self.counts["total"] = sum(1 for line in f if line.strip())
+            self.counts["skipped"] = len(done)
+            self.status = "in_progress"
+            self.in_progress_at = int(time.time())
+            self._started = time.time()
+            self.save_checkpoint()
+            print(f">>> [Batch {self.id}] {self.counts['total']} items, {len(done)} already done, concurrency {self.limit()} / 条目总数、已完成数、并发数")
+
+            slots = asyncio.Semaphore(self.limit())
+            # custom_id -> first line using it / custom_id -> 首次使用它的行号
+            seen = {}
+            with open(self.input_file, "r", encoding="utf-8") as source, open(self.output_file, "a", encoding="utf-8") as out:
+                for line_no, line in enumerate(source, 1):
+                    if not line.strip(): continue
+                    try:
+                        item = json.loads(line)
+                    except ValueError as e:
+                        item = {"custom_id": f"line-{line_no}", "_invalid": str(e)}
+                    if not isinstance(item, dict):
+                        item = {"custom_id": f"line-{line_no}", "_invalid": "Line is not a JSON object"}
+                    elif item.get("url", "/v1/chat/completions") != "/v1/chat/completions":
+                        item["_invalid"] = f"Unsupported url: {item['url']}"
+                    custom_id = batch_custom_id(item, line_no)
+                    if custom_id in seen:
+                        # Fail the repeat under an id of its own, so resume still runs the first line
+                        # 以独立的 id 记录重复行的失败，使恢复时仍会执行首次出现的那一行
+                        item = {"_invalid": f"Duplicate custom_id {custom_id!r}, first used on line {seen[custom_id]}"}
+                        custom_id = f"{custom_id}#line-{line_no}"
+                    else:
+                        seen[custom_id] = line_no
+                    if custom_id in done: continue
+                    await slots.acquire()
+                    task = asyncio.create_task(self._process(custom_id, item, out))
+                    self._items.add(task)
+                    task.add_done_callback(lambda t: self._item_done(t, slots))
+                    if self._crash is not None: break
+                if self._items:
+                    await asyncio.gather(*self._items, return_exceptions=True)
+            if self._crash is not None:
+                raise self._crash
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
         except Exception as e:
-            print(f"!!! Error processing request / 处理请求出错: {e}")
-            return {"error": str(e)}
+            print(f"!!! [Batch {self.id}] Failed / 批处理失败: {e}")
+            self.status = "failed"
+            self.error = str(e)
         finally:
-            browser_lock.release()
-    else:
-        return {"error": "Browser Busy"}
-    
+            for task in list(self._items):
+                task.cancel()
+            if self._items:
+                await asyncio.gather(*self._items, return_exceptions=True)
+            self.completed_at = int(time.time())
+            if self.status != "validating":
+                self.save_checkpoint()
+            print(f">>> [Batch {self.id}] {self.status} | {self.counts}")
+
+    async def _process(self, custom_id, item, out):
+        """
+        Answer one line, retrying with exponential back-off, then append its result.
+        回答一行请求，失败时按指数退避重试，然后追加写入结果。
+        """
+        body = item.get("body", item)
+        max_retries = item.get("max_retries", self.max_retries)
+        attempt = 0
+        while True:
+            status_code, response, error = 200, None, None
+            try:
+                if "_invalid" in item: raise ValueError(item["_invalid"])
+                if not isinstance(body, dict): raise ValueError("body must be a JSON object")
+                try:
+                    max_retries = max(0, int(max_retries))
+                except (TypeError, ValueError):
+                    raise ValueError(f"Invalid max_retries: {max_retries!r}")
+                response = await run_batch_item(body)
+                break
+            except QueueFullError as e:
+                # Other traffic filled the queue: wait without spending a retry
+                # 其他请求占满了队列：等待，不消耗重试次数
+                await asyncio.sleep(e.retry_after)
+                continue
+            except ValueError as e:
+                status_code, error = 400, {"code": "invalid_request", "message": str(e)}
+                break
+            except GenerationError as e:
+                status_code, error = 502, {"code": error_kind(str(e)), "message": str(e)}
+            except Exception as e:
+                status_code, error = 500, {"code": "exception", "message": str(e)}
+            if attempt >= max_retries: break
+            attempt += 1
+            self.retried += 1
+            BATCH_ITEMS.inc(result="retried")
+            delay = self.retry_backoff * 2 ** (attempt - 1)
+            print(f"!!! [Batch {self.id}] {custom_id} failed ({error['message']}), retry {attempt}/{max_retries} in {delay:g}s / 失败，稍后重试")
+            await asyncio.sleep(delay)
+
+        result = {
+            "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": response} if response else None,
+            "error": error,
+            "attempts": attempt + 1,
+        }
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+        result_kind = "failed" if error else "completed"
+        self.counts[result_kind] += 1
+        BATCH_ITEMS.inc(result=result_kind)
+        # Disk syncs stay off the event loop / 磁盘同步不在事件循环中执行
+        await asyncio.to_thread(self._persist, out, self.checkpoint_state())
+
+batches = {}
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """
+    Body: {"input_file": "...", "output_file": "...", "max_retries": 2, "retry_backoff": 5,
+           "concurrency": 0, "resume": false, "retry_failed": false}. Paths must be inside BATCH_DIR.
+    请求体字段如上。路径必须位于 BATCH_DIR 之内。
+    """
+    try: data = await request.json()
+    except: return JSONResponse(status_code=400, content={"error": "Invalid JSON body"})
+    input_file = resolve_batch_path(data.get("input_file"))
+    if not input_file or not os.path.isfile(input_file):
+        return JSONResponse(status_code=400, content={"error": f"Input file not found in the batch directory: {data.get('input_file')}"})
+    output_file = resolve_batch_path(data.get("output_file") or os.path.splitext(input_file)[0] + ".output.jsonl")
+    if not output_file or output_file == input_file:
+        return JSONResponse(status_code=400, content={"error": f"Output file must be another file in the batch directory: {data.get('output_file')}"})
+    if any(batch.output_file == output_file and not batch.task.done() for batch in batches.values()):
+        return JSONResponse(status_code=409, content={"error": "A batch is already writing to this output file"})
+
+    options = {"batch_id": None, "created_at": None}
+    if data.get("resume"):
+        try:
+            with open(output_file + ".checkpoint.json", "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            options = {"batch_id": checkpoint["id"], "created_at": checkpoint["created_at"],
+                       **{key: checkpoint["options"][key] for key in ("max_retries", "retry_backoff")}}
+        except (OSError, ValueError, KeyError):
+            pass
+    elif os.path.exists(output_file):
+        return JSONResponse(status_code=409, content={"error": "Output file exists, pass \"resume\": true to continue it"})
+    for key in ("max_retries", "retry_backoff", "concurrency", "retry_failed"):
+        if data.get(key) is not None:
+            options[key] = data[key]
+
+    batch = BatchJob(input_file, output_file, **options)
+    batches[batch.id] = batch
+    batch.start()
+    return batch.to_dict()
+
+@app.get("/v1/batches")
+async def list_batches():
+    return {"object": "list", "data": [batch.to_dict() for batch in batches.values()]}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "Batch not found"})
+    return batch.to_dict()
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "Batch not found"})
+    batch.cancel()
+    return batch.to_dict()
+
 if __name__ == "__main__":
     import uvicorn
     # Start the server with the configured port
@@ -0,0 +1,11 @@
+"""
+main.py reads config.json from the working directory at import time, so tests import it
+from a scratch directory and never touch the real config.
+main.py 在导入时从工作目录读取 config.json，因此测试在临时目录中导入，不会改动真实配置。
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="webai-tests-"))
@@ -0,0 +1,40 @@
+import main
+from main import BrowserProfile, ConversationMap, ConversationPlan, TabPool, TabWorker
+
+def make_pool(*names):
+    profiles = {name: BrowserProfile(name, f"/tmp/{name}", 9333) for name in names}
+    pool = TabPool()
+    for index, name in enumerate(names):
+        pool.add(TabWorker(index, object(), profile=profiles[name]))
+    return pool, profiles
+
+def test_acquire_prefers_the_owning_tab():
+    pool, _ = make_pool("a", "a", "b")
+    assert pool.acquire(("a", 1)).index == 1
+    # Owning tab busy: another tab of the same profile / 所属标签页忙碌：使用同一配置的其他标签页
+    assert pool.acquire(("a", 1)).index == 0
+
+def test_acquire_waits_for_a_busy_owner_but_not_for_a_missing_one():
+    pool, profiles = make_pool("a", "b")
+    owner = pool.acquire(("a", 0))
+    assert pool.acquire(("a", 0)) is None
+    pool.release(owner)
+    profiles["a"].state = "recovering"
+    assert pool.acquire(("a", 0)).profile.name == "b"
+
+def test_map_records_owner_and_plan_routes_to_it(tmp_path, monkeypatch):
+    conversation_map = ConversationMap(str(tmp_path / "map.json"))
+    monkeypatch.setattr(main, "conversation_map", conversation_map)
+    messages = [{"role": "user", "content": "hi"}]
+    plan = ConversationPlan(messages, None, 0)
+    assert plan.affinity is None
+    pool, _ = make_pool("a", "b")
+    plan.finished("https://gemini.google.com/app/abc", pool.workers[1])
+    plan.register_answer("hello")
+
+    follow_up = main.plan_conversation(messages + [{"role": "assistant", "content": "hello"}, {"role": "user", "content": "more"}])
+    assert follow_up.chat_url == "https://gemini.google.com/app/abc"
+    assert follow_up.start == plan.turns == 2
+    assert follow_up.affinity == ("b", 1)
+    # Survives a restart / 重启后依然有效
+    assert ConversationMap(str(tmp_path / "map.json")).lookup(main.message_prefix_hashes(messages + [{"role": "assistant", "content": "hello"}])[-1])["profile"] == "b"
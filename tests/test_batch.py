@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import main
+from main import read_batch_output, resolve_batch_path
+
+def result_line(custom_id, error=None):
+    return json.dumps({"id": "batch_req_x", "custom_id": custom_id, "response": None, "error": error, "attempts": 1}) + "\n"
+
+@pytest.fixture
+def batch_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_DIR", os.path.realpath(tmp_path))
+    return tmp_path
+
+def test_resolve_batch_path_stays_inside_the_batch_dir(batch_dir):
+    assert resolve_batch_path("in.jsonl") == str(batch_dir / "in.jsonl")
+    assert resolve_batch_path(str(batch_dir / "sub" / "in.jsonl")) == str(batch_dir / "sub" / "in.jsonl")
+    for path in ("../in.jsonl", "/etc/passwd", str(batch_dir), "", None):
+        assert resolve_batch_path(path) is None
+
+def test_partial_last_line_is_truncated(batch_dir):
+    path = batch_dir / "out.jsonl"
+    path.write_text(result_line("a") + result_line("b")[:20])
+    assert read_batch_output(str(path)) == {"a"}
+    assert path.read_text() == result_line("a")
+
+def test_drop_failed(batch_dir):
+    path = batch_dir / "out.jsonl"
+    path.write_text(result_line("a") + result_line("b", {"code": "toast"}))
+    assert read_batch_output(str(path)) == {"a", "b"}
+    assert read_batch_output(str(path), drop_failed=True) == {"a"}
+    assert path.read_text() == result_line("a")
+
+@pytest.mark.parametrize("content", ['{"custom_id": "a"}\n', result_line("a") + "notes\n", result_line("a") + "partial"])
+def test_other_files_are_never_modified(batch_dir, content):
+    path = batch_dir / "out.jsonl"
+    path.write_text(content)
+    with pytest.raises(ValueError):
+        read_batch_output(str(path), drop_failed=True)
+    assert path.read_text() == content
+    assert not os.path.exists(str(path) + ".tmp")
+
+def run_batch(tmp_path, lines, **options):
+    source = tmp_path / "in.jsonl"
+    source.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    async def scenario():
+        batch = main.BatchJob(str(source), str(tmp_path / "out.jsonl"), concurrency=2, retry_backoff=0, **options)
+        batch.start()
+        await batch.task
+        return batch
+
+    batch = asyncio.run(scenario())
+    results = {}
+    for line in (tmp_path / "out.jsonl").read_text().splitlines():
+        result = json.loads(line)
+        results[result["custom_id"]] = result
+    return batch, results
+
+def test_bad_item_options_are_recorded_as_invalid_requests(tmp_path, monkeypatch):
+    async def answer(body):
+        return {"choices": [{"message": {"content": "ok"}}]}
+    monkeypatch.setattr(main, "run_batch_item", answer)
+    messages = [{"role": "user", "content": "hi"}]
+    batch, results = run_batch(tmp_path, [
+        {"custom_id": "a", "body": {"messages": messages}},
+        {"custom_id": "b", "max_retries": None, "body": {"messages": messages}},
+        {"custom_id": "c", "max_retries": "abc", "body": {"messages": messages}},
+        {"custom_id": "a", "body": {"messages": messages}},
+    ])
+    assert batch.status == "completed"
+    assert batch.counts == {"total": 4, "completed": 1, "failed": 3, "skipped": 0}
+    for custom_id in ("b", "c", "a#line-4"):
+        assert results[custom_id]["error"]["code"] == "invalid_request"
+        assert results[custom_id]["response"] is None
+
+def test_an_item_that_writes_no_result_fails_the_batch(tmp_path, monkeypatch):
+    async def broken(self, custom_id, item, out):
+        raise OSError("disk full")
+    monkeypatch.setattr(main.BatchJob, "_process", broken)
+    batch, results = run_batch(tmp_path, [{"messages": [{"role": "user", "content": "hi"}]}])
+    assert batch.status == "failed" and batch.error == "disk full"
+    assert results == {}
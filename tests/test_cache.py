@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+import main
+from main import EVENT_DELTA, EVENT_DONE, EVENT_ERROR, ResponseCache, store_on_success
+
+async def collect(events):
+    return [event async for event in events]
+
+async def source(*events):
+    for event in events:
+        yield event
+
+@pytest.mark.parametrize("events, stored", [
+    ([(EVENT_DELTA, "hi"), (EVENT_DONE, "stable")], True),
+    ([(EVENT_DELTA, "hi"), (EVENT_DONE, "timeout")], False),
+    ([(EVENT_DELTA, "hi"), (EVENT_ERROR, "Gemini Error"), (EVENT_DONE, "network")], False),
+    ([(EVENT_DONE, "network")], False),
+])
+def test_store_on_success(monkeypatch, events, stored):
+    cache = ResponseCache(ttl=60, max_entries=8)
+    monkeypatch.setattr(main, "response_cache", cache)
+    assert asyncio.run(collect(store_on_success(source(*events), "key"))) == events
+    assert (cache.get("key") is not None) == stored
@@ -0,0 +1,18 @@
+import base64
+
+import pytest
+
+from main import download_image_to_base64
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(64))
+
+@pytest.mark.parametrize("wrap", [0, 4, 10, 76])
+def test_data_uri_type_is_sniffed_even_when_wrapped(wrap):
+    encoded = base64.b64encode(PNG).decode()
+    if wrap:
+        encoded = "\n".join(encoded[i:i + wrap] for i in range(0, len(encoded), wrap))
+    # Declared as JPEG on purpose: the bytes decide / 故意声明为 JPEG：以实际字节为准
+    assert download_image_to_base64("data:image/jpeg;base64," + encoded) == (encoded, "image/png")
+
+def test_undecodable_head_keeps_the_declared_type():
+    assert download_image_to_base64("data:image/gif;base64,!!!!") == ("!!!!", "image/gif")
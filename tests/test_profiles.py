@@ -0,0 +1,81 @@
+import time
+
+import main
+from main import BrowserProfile, TabPool, TabWorker
+
+def make_profiles(monkeypatch, count):
+    profiles = [BrowserProfile(f"p{i}", f"/tmp/p{i}", 9333 + i) for i in range(count)]
+    monkeypatch.setattr(main, "browser_profiles", profiles)
+    return profiles
+
+def test_single_profile_is_never_cooled_down(monkeypatch):
+    (profile,) = make_profiles(monkeypatch, 1)
+    profile.record_failure("toast", "出现了点问题")
+    assert profile.available()
+    assert profile.stats["errors"] == 1 and profile.stats["cooldowns"] == 0
+
+def test_failing_profile_is_cooled_down_while_another_serves(monkeypatch):
+    first, second = make_profiles(monkeypatch, 2)
+    first.record_failure("toast")
+    assert not first.available() and second.available()
+    # The last serving profile stays in rotation / 最后一个可用配置保持轮换
+    second.record_failure("toast")
+    assert second.available()
+
+class ProbeTab:
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.timeouts = []
+
+    def run_js(self, script, timeout=None):
+        self.timeouts.append(timeout)
+        answer = self.answers.pop(0)
+        if answer is None: raise TimeoutError("timeout")
+        return answer
+
+def test_watchdog_needs_several_failed_probes(monkeypatch):
+    watchdog = main.BrowserWatchdog(main.TabPool(), [], 0, probe_timeout=3)
+    monkeypatch.setattr(watchdog, "PROBE_PAUSE", 0)
+    assert not watchdog.confirm_dead(ProbeTab(None, ["https://gemini.google.com/app", True]))
+    tab = ProbeTab(None, None, None)
+    assert watchdog.confirm_dead(tab)
+    # Every probe bounds its own CDP call / 每次探测都限制自身 CDP 调用的时长
+    assert tab.timeouts == [3, 3, 3]
+
+class FakeThread:
+    def start(self):
+        pass
+
+def watched_profiles(monkeypatch, answers):
+    main_profile = BrowserProfile("main", "/tmp/main", 9333)
+    standby = BrowserProfile("spare", "/tmp/spare", 9334, standby=True)
+    pool = TabPool()
+    pool.add(TabWorker(0, ProbeTab(*answers), profile=main_profile))
+    watchdog = main.BrowserWatchdog(pool, [main_profile, standby], 0, probe_timeout=3)
+    monkeypatch.setattr(watchdog, "PROBE_PAUSE", 0)
+    rebuilt = []
+    monkeypatch.setattr(watchdog, "_rebuild", rebuilt.append)
+    return watchdog, main_profile, standby, rebuilt
+
+def wait_for(condition):
+    deadline = time.time() + 2
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_first_unanswered_probe_fails_over_and_a_recovery_restores(monkeypatch):
+    watchdog, profile, standby, rebuilt = watched_profiles(monkeypatch, [None, ["https://gemini.google.com/app", True]])
+    started = []
+    monkeypatch.setattr(main.threading, "Thread", lambda target, args, **kwargs: started.append((target, args)) or FakeThread())
+    watchdog.check(profile)
+    # Traffic moved before any confirmation ran / 在任何确认之前流量已转移
+    assert profile.state == "suspect" and standby.state == "active"
+    target, args = started.pop()
+    target(*args)
+    assert profile.state == "active" and standby.state == "standby" and rebuilt == []
+
+def test_confirmed_dead_browser_is_rebuilt(monkeypatch):
+    watchdog, profile, standby, rebuilt = watched_profiles(monkeypatch, [None, None, None])
+    watchdog.check(profile)
+    assert wait_for(lambda: rebuilt == [profile])
+    assert profile.state == "recovering" and standby.state == "active"
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+import main
+from main import InFlight, RequestScheduler, TabPool, EVENT_DELTA, EVENT_DONE
+
+def make_request(body, **headers):
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+        # The client never disconnects / 客户端从不断开
+        await asyncio.Event().wait()
+
+    scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions",
+             "headers": [(name.replace("_", "-").encode(), str(value).encode()) for name, value in headers.items()]}
+    return Request(scope, receive)
+
+def chat(content):
+    return {"messages": [{"role": "user", "content": content}], "clean_json": False}
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    # No tabs and no loop: every job stays queued / 没有标签页也没有事件循环：所有任务保持排队
+    scheduler = RequestScheduler(TabPool(), max_queue_size=1)
+    monkeypatch.setattr(main, "scheduler", scheduler)
+    monkeypatch.setattr(main, "in_flight", {})
+    monkeypatch.setattr(main, "response_cache", None)
+    monkeypatch.setattr(main, "DISCONNECT_POLL_INTERVAL", 0.01)
+    return scheduler
+
+def test_full_queue_answers_429_with_retry_after(scheduler):
+    async def scenario():
+        scheduler.submit(lambda worker: iter(()))
+        return await main.chat_completions(make_request(chat("hi")))
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+
+def test_joiner_keeps_the_shared_job_when_the_leader_times_out(scheduler):
+    async def scenario():
+        leader = asyncio.ensure_future(main.chat_completions(make_request(chat("same"), x_request_timeout=0.05)))
+        await asyncio.sleep(0.01)
+        joiner = asyncio.ensure_future(main.chat_completions(make_request(chat("same"), x_request_timeout=30)))
+        response = await leader
+        (flight,) = main.in_flight.values()
+        still_queued = flight.job in scheduler._pending and not flight.job.cancelled
+        joiner.cancel()
+        return response, still_queued
+
+    response, still_queued = asyncio.run(scenario())
+    assert response.status_code == 503
+    assert still_queued
+
+def test_joiner_replay_and_abort_after_the_last_client_leaves(scheduler):
+    async def scenario():
+        job = scheduler.submit(lambda worker: iter(()))
+        flight = InFlight("key", job, job.stream())
+        main.in_flight["key"] = flight
+        job.events.put_nowait((EVENT_DELTA, "a"))
+        job.events.put_nowait((EVENT_DELTA, "b"))
+        await asyncio.sleep(0)
+        flight.attach()
+        flight.attach()
+        leader, joiner = flight.subscribe(), flight.subscribe()
+        replayed = [await joiner.__anext__(), await joiner.__anext__()]
+        await leader.__anext__()
+        await leader.aclose()
+        kept = not job.cancelled
+        await joiner.aclose()
+        return replayed, kept, job
+
+    replayed, kept, job = asyncio.run(scenario())
+    assert replayed == [(EVENT_DELTA, "a"), (EVENT_DELTA, "b")]
+    # One client leaving keeps the job; the last one aborts it / 一个客户端离开不影响任务；最后一个离开时中止
+    assert kept
+    assert job.cancelled and job not in scheduler._pending
+    assert main.in_flight == {}
+
+def test_finished_flight_is_not_aborted(scheduler):
+    async def scenario():
+        job = main.Job(lambda worker: iter(()))
+        flight = InFlight("key", job, main.replay_cached("ok", "network"))
+        flight.attach()
+        events = [event async for event in flight.subscribe()]
+        return events, job
+
+    events, job = asyncio.run(scenario())
+    assert events[-1] == (EVENT_DONE, "network")
+    assert not job.abort.is_set()
@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from main import EVENT_DELTA, EVENT_DONE, InFlight, sse_stream
+
+async def source(*events):
+    for event in events:
+        yield event
+
+def parse(frames):
+    text, chunks = "", []
+    for frame in frames:
+        for line in frame.decode("utf-8").split("\n\n"):
+            if not line.startswith("data: ") or line == "data: [DONE]": continue
+            chunk = json.loads(line[6:])
+            chunks.append(chunk)
+            text += chunk["choices"][0]["delta"].get("content", "") if chunk.get("choices") else ""
+    return text, chunks
+
+async def render(events):
+    return [frame async for frame in sse_stream(events)]
+
+@pytest.fixture(autouse=True)
+def coalescing(monkeypatch):
+    monkeypatch.setattr(main, "SSE_MIN_FLUSH_SECONDS", 0.05)
+    monkeypatch.setattr(main, "SSE_MIN_FLUSH_CHARS", 64)
+    monkeypatch.setattr(main, "SSE_MAX_LATENCY_SECONDS", 0.2)
+
+def test_back_to_back_deltas_before_the_first_flush():
+    # A non-empty queue does not suspend, so both deltas arrive before any frame is written
+    # 非空队列不会挂起，因此两个增量在写出任何帧之前就已到达
+    frames = asyncio.run(render(source((EVENT_DELTA, "a" * 10), (EVENT_DELTA, "b" * 100), (EVENT_DONE, "network"))))
+    text, chunks = parse(frames)
+    assert text == "a" * 10 + "b" * 100
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    assert frames[-1].endswith(b"data: [DONE]\n\n")
+
+def test_late_joiner_replays_history(monkeypatch):
+    monkeypatch.setattr(main, "in_flight", {})
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def leader():
+            yield (EVENT_DELTA, "x" * 30)
+            yield (EVENT_DELTA, "y" * 50)
+            await release.wait()
+            yield (EVENT_DONE, "network")
+
+        flight = InFlight("key", object(), leader())
+        await asyncio.sleep(0)
+        assert len(flight.history) == 2
+        flight.attach()
+        joiner = asyncio.ensure_future(render(flight.subscribe()))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await joiner
+
+    text, _ = parse(asyncio.run(scenario()))
+    assert text == "x" * 30 + "y" * 50
@@ -0,0 +1,74 @@
+import pytest
+
+from main import JsonExtractor, parse_response_format, validate_json_schema
+
+def extract(answer, opener="{", step=1):
+    extractor = JsonExtractor(opener)
+    for start in range(0, len(answer), step):
+        extractor.feed(answer[start:start + step])
+    return extractor
+
+@pytest.mark.parametrize("step", [1, 3, 1000])
+def test_extracts_first_object_from_prose(step):
+    extractor = extract('Here you go: {"a": {"b": [1, "}"]}, "c": "x\\"{"} and {"later": 1}', step=step)
+    assert extractor.complete
+    assert extractor.value == {"a": {"b": [1, "}"]}, "c": 'x"{'}
+
+def test_incomplete_object_is_not_complete():
+    extractor = extract('{"a": {"b": 1}')
+    assert not extractor.complete
+    assert extractor.value is None
+
+@pytest.mark.parametrize("answer, expected", [
+    ('{"action": [{"click": {"index": 3}}], "done": false,}', {"action": [{"click": {"index": 3}}], "done": False}),
+    ('{"a": True, "b": {"c": 1}}', {"a": True, "b": {"c": 1}}),
+])
+def test_malformed_outer_object_is_repaired_not_rescanned(answer, expected):
+    extractor = extract(answer)
+    assert extractor.complete
+    assert extractor.value == expected
+
+def test_unrepairable_candidate_is_skipped_as_a_whole():
+    extractor = extract("Use {placeholder} like this: {\"ok\": 1}")
+    assert extractor.value == {"ok": 1}
+
+def test_array_opener():
+    extractor = extract('List: [1, {"a": [2]}, 3] done', opener="[")
+    assert extractor.value == [1, {"a": [2]}, 3]
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"$ref": "#/$defs/tag"}, "maxItems": 2},
+        "kind": {"enum": ["a", "b"]},
+    },
+    "required": ["name"],
+    "additionalProperties": False,
+    "$defs": {"tag": {"type": "string"}},
+}
+
+@pytest.mark.parametrize("value, error", [
+    ({"name": "x", "age": 3, "tags": ["t"], "kind": "a"}, None),
+    ({"age": 3}, "$: missing required property 'name'"),
+    ({"name": "x", "age": True}, "$.age: expected integer, got bool"),
+    ({"name": "x", "tags": ["t", 1]}, "$.tags[1]: expected string, got int"),
+    ({"name": "x", "tags": ["a", "b", "c"]}, "$.tags: too many items"),
+    ({"name": "x", "kind": "c"}, "$.kind: 'c' not in enum"),
+    ({"name": "x", "extra": 1}, "$: unexpected property 'extra'"),
+    ([], "$: expected object, got list"),
+])
+def test_validate_json_schema(value, error):
+    assert validate_json_schema(value, SCHEMA) == error
+
+def test_validate_any_of():
+    schema = {"anyOf": [{"type": "string"}, {"type": "null"}]}
+    assert validate_json_schema(None, schema) is None
+    assert validate_json_schema(1, schema) == "$: does not match any allowed schema"
+
+def test_clean_json_early_stop_is_non_stream_only():
+    assert parse_response_format({}, clean_json=True).source == "clean_json"
+    assert parse_response_format({}, clean_json=True, is_stream=True) is None
+    explicit = parse_response_format({"response_format": {"type": "json_object"}}, clean_json=True, is_stream=True)
+    assert explicit.source == "response_format"